@@ -1,15 +1,2129 @@
-import json, http.client, ssl, os, logging, base64, time, hashlib
+import json, http.client, ssl, os, logging, time, hashlib, sqlite3, tempfile, threading, select, functools
+import asyncio, queue, codecs, collections, re, html, socket, weakref, math, heapq, hmac, datetime, zlib, secrets
+from concurrent.futures import ThreadPoolExecutor
 from flask import Response, request, abort
 from searx.plugins import Plugin, PluginInfo
 from searx.result_types import EngineResults
 from flask_babel import gettext
 from markupsafe import Markup
 
+try:
+    # Optional, only for SEMANTIC_REUSE
+    import numpy as np
+except ImportError:
+    np = None
+
 logger = logging.getLogger(__name__)
 
 # Constants
 TOKEN_EXPIRY_SEC = 60
+# With the context stashed, an /ai-stream body only carries the query and token
+STREAM_BODY_MAX_BYTES = 4096
 CONNECTION_TIMEOUT_SEC = 30
+STREAM_HEADERS = {
+    'X-Accel-Buffering': 'no',
+    'Cache-Control': 'no-cache, no-store',
+    'Connection': 'keep-alive',
+    'Content-Encoding': 'identity'
+}
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+def _normalize_query(q):
+    return " ".join(q.casefold().split())
+
+def _answer_key(provider, model, query, context):
+    ctx_hash = hashlib.sha256(context.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f"{provider}\0{model}\0{_normalize_query(query)}\0{ctx_hash}".encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _ssl_context():
+    # Loading the CA bundle is expensive; build the context once per process
+    return ssl.create_default_context()
+
+
+class ConnectionPool:
+    # Per-host keep-alive pool for upstream HTTP(S) connections, shared by all providers
+
+    def __init__(self, max_per_host, max_idle):
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+        # Sockets opened before a fork (e.g. by warm-up) must not be shared with the workers
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        self._lock = threading.Lock()
+        for idle in self._idle.values():
+            for conn, _ in idle:
+                conn.close()
+        self._idle = {}
+
+    def _connect(self, key):
+        secure, host = key
+        if secure:
+            conn = http.client.HTTPSConnection(host, timeout=CONNECTION_TIMEOUT_SEC, context=_ssl_context())
+        else:
+            conn = http.client.HTTPConnection(host, timeout=CONNECTION_TIMEOUT_SEC)
+        conn.pool_key = key
+        started = time.perf_counter()
+        conn.connect()
+        conn.connect_time = time.perf_counter() - started
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        sock = conn.sock
+        if sock is None or time.monotonic() - idle_since > self.max_idle:
+            return False
+        try:
+            tls = isinstance(sock, ssl.SSLSocket)
+            if tls and sock.pending():
+                return False
+            # An idle keep-alive socket must have nothing to read; readable means EOF or garbage
+            if not select.select([sock], [], [], 0)[0]:
+                return True
+            if not tls:
+                return False
+            # ...except that TLS 1.3 servers send session tickets after the handshake. A non-blocking
+            # read processes such records; only EOF or application data means the socket is unusable.
+            sock.settimeout(0)
+            try:
+                sock.recv(1)
+                return False
+            except ssl.SSLWantReadError:
+                return True
+        except (OSError, ValueError):
+            return False
+
+    def acquire(self, host, secure):
+        key = (secure, host)
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, idle_since = idle.pop()
+                if self._healthy(conn, idle_since):
+                    conn.sock.settimeout(CONNECTION_TIMEOUT_SEC)
+                    conn.connect_time = 0.0
+                    return conn, True
+                conn.close()
+        return self._connect(key), False
+
+    def request(self, host, secure, method, path, body, headers):
+        conn, reused = self.acquire(host, secure)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError) as e:
+            conn.close()
+            if not reused:
+                raise
+            # The server dropped a pooled connection between our health check and the request
+            logger.debug(f"AI Answers: stale pooled connection to {host}, reconnecting: {e}")
+        except Exception:
+            conn.close()
+            raise
+        conn = self._connect((secure, host))
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            return conn, conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    def drain(self, conn, res, limit=65536):
+        # Read the tail after a terminal event (e.g. SSE [DONE]) so the connection can be reused
+        try:
+            if conn.sock is not None:
+                conn.sock.settimeout(1.0)
+            res.read(limit)
+        except Exception:
+            pass
+
+    def release(self, conn, res=None):
+        # Only fully consumed responses on connections the server keeps open go back to the pool;
+        # anything abandoned mid-stream is closed so no unread bytes leak into the next request
+        if res is None or not res.isclosed() or res.will_close or conn.sock is None:
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(conn.pool_key, [])
+            if len(idle) >= self.max_per_host:
+                conn.close()
+                return
+            idle.append((conn, time.monotonic()))
+
+    def prewarm(self, host, secure):
+        # Opens a connection ahead of the next request unless an idle one stays usable for at least
+        # half of max_idle, so refreshing every max_idle / 2 always leaves one; returns connect time
+        key = (secure, host)
+        with self._lock:
+            idle = []
+            for conn, idle_since in self._idle.get(key, []):
+                if self._healthy(conn, idle_since):
+                    idle.append((conn, idle_since))
+                else:
+                    conn.close()
+            self._idle[key] = idle
+            if any(time.monotonic() - idle_since < self.max_idle / 2 for _, idle_since in idle):
+                return 0.0
+        conn = self._connect(key)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) >= self.max_per_host:
+                conn.close()
+            else:
+                idle.append((conn, time.monotonic()))
+        return conn.connect_time
+
+    def stats(self):
+        with self._lock:
+            return {f"{'https' if secure else 'http'}://{host}": len(idle) for (secure, host), idle in self._idle.items()}
+
+
+READ_MIN = 1024
+READ_MAX = 65536
+
+
+class SSEParser:
+    # Incremental parser for OpenAI-style `data:` event streams. Lines are framed on raw bytes
+    # (b"\n" never occurs inside a multi-byte UTF-8 sequence) and only newly read bytes are
+    # searched, so a payload is copied once and characters split across reads stay intact.
+
+    def __init__(self):
+        self.done = False
+        self.usage = None
+        self._pending = b""
+        self._decode = json.JSONDecoder().raw_decode
+
+    def feed(self, data):
+        if b"\n" not in data:
+            self._pending += data
+            return []
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        out = []
+        for line in lines:
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                self.done = True
+                break
+            try:
+                obj, _ = self._decode(payload.decode('utf-8'))
+                # With stream_options.include_usage the token counts arrive in a last chunk without choices
+                if obj.get("usage"): self.usage = obj["usage"]
+                content = obj.get("choices", [{}])[0].get("delta", {}).get("content", "")
+                if content: out.append(content)
+            except (ValueError, AttributeError, IndexError):
+                pass
+        return out
+
+
+class JSONArrayParser:
+    # Incremental parser for Gemini's streamed JSON array (`[{...},\r\n{...}]`). Bytes go through
+    # an incremental UTF-8 decoder, elements are decoded in place with raw_decode(text, pos), and
+    # only the unfinished tail is carried over, so each element is parsed once.
+
+    _SKIP = re.compile(r'[\s,\[]*')
+
+    def __init__(self):
+        self.done = False
+        self.usage = None
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decode = json.JSONDecoder().raw_decode
+        self._text = ""
+
+    def feed(self, data):
+        chunk = self._utf8.decode(data)
+        text = self._text + chunk
+        self._text = text
+        # An element (or the array) can only complete on a closing bracket
+        if '}' not in chunk and ']' not in chunk:
+            return []
+        out = []
+        pos = 0
+        while True:
+            pos = self._SKIP.match(text, pos).end()
+            if pos >= len(text):
+                break
+            if text[pos] == ']':
+                self.done = True
+                break
+            try:
+                obj, pos = self._decode(text, pos)
+            except json.JSONDecodeError:
+                break
+            text_part = self._candidate_text(obj)
+            if text_part: out.append(text_part)
+            if isinstance(obj, dict) and obj.get('usageMetadata'):
+                self.usage = obj['usageMetadata']
+        self._text = text[pos:]
+        return out
+
+    @staticmethod
+    def _candidate_text(obj):
+        try:
+            candidates = obj.get('candidates', [])
+            if candidates:
+                parts = candidates[0].get('content', {}).get('parts', [])
+                if parts:
+                    return parts[0].get('text', '')
+        except AttributeError:
+            pass
+        return ''
+
+
+STREAM_PARSERS = {"sse": SSEParser, "json-array": JSONArrayParser}
+
+
+def _prompt_usage(usage):
+    # (prompt tokens, of which served from the provider's prompt cache) from an OpenAI-style
+    # `usage` or a Gemini `usageMetadata` object; providers without cache reporting give 0 cached
+    if not isinstance(usage, dict):
+        return 0, 0
+    if 'promptTokenCount' in usage:
+        return int(usage.get('promptTokenCount') or 0), int(usage.get('cachedContentTokenCount') or 0)
+    details = usage.get('prompt_tokens_details') or {}
+    return int(usage.get('prompt_tokens') or 0), int(details.get('cached_tokens') or 0)
+
+
+def _record_usage(metrics, labels, usage):
+    prompt, cached = _prompt_usage(usage)
+    if metrics and prompt:
+        metrics.inc("ai_answers_prompt_tokens_total", labels, prompt)
+        metrics.inc("ai_answers_cached_prompt_tokens_total", labels, cached)
+
+
+UpstreamRequest = collections.namedtuple('UpstreamRequest', 'label secure host path body headers protocol provider model')
+
+
+class _StreamEnd:
+    def __init__(self, ok):
+        self.ok = ok
+
+
+def _from_queue(chunks, idle_sec=None):
+    # Yields queued deltas until the end marker. With idle_sec, an empty string is yielded once
+    # when nothing has followed a delta for that long, so response coalescing can flush on time.
+    timeout = None
+    while True:
+        try:
+            item = chunks.get(timeout=timeout)
+        except queue.Empty:
+            timeout = None
+            yield ""
+            continue
+        if isinstance(item, _StreamEnd):
+            return item.ok
+        timeout = idle_sec
+        yield item
+
+
+class AsyncStreamEngine:
+    # Drives the router's upstream streams concurrently on one asyncio loop thread per worker,
+    # so hedged streams can race and the losers be cancelled. Callers get a plain iterator, so
+    # Flask responses and the caching wrapper work unchanged; it blocks its request thread.
+
+    def __init__(self, concurrency, metrics=None, pool_size=8, max_idle=30):
+        self.concurrency = concurrency
+        self.metrics = metrics
+        self.pool_size = pool_size
+        self.max_idle = max_idle
+        self.active = 0
+        self._idle = {}
+        self._loop = None
+        self._pid = None
+        self._sem = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            # Start lazily so every forked worker gets its own loop thread
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                self._sem = None
+                # Connections belong to the loop (and process) that opened them
+                self._idle = {}
+                threading.Thread(target=self._loop.run_forever, name="ai-answers-async", daemon=True).start()
+            return self._loop
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stream(self, req, abort=None, idle_sec=None):
+        # Bridge: the loop pushes deltas into a queue, the WSGI iterator pops them (blocking the
+        # request thread in between, as WSGI gives a response no other way to wait)
+        chunks = queue.SimpleQueue()
+        future = self.submit(self._pump(req, chunks.put))
+        if abort:
+            # The end marker unblocks the iterator even if the task is cancelled before it starts
+            abort.set(lambda: (future.cancel(), chunks.put(_StreamEnd(None))))
+        try:
+            return (yield from _from_queue(chunks, idle_sec))
+        finally:
+            future.cancel()
+
+    async def _pump(self, req, emit):
+        ok = None
+        try:
+            ok = await self.run(req, emit)
+        finally:
+            emit(_StreamEnd(ok))
+
+    async def run(self, req, emit):
+        # Calls emit(text) for each delta; returns True once the upstream stream completed
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        async with self._sem:
+            self.active += 1
+            try:
+                return await self._fetch(req, emit)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"{req.label} Stream Exception: {e}")
+                if self.metrics:
+                    self.metrics.inc("ai_answers_upstream_exceptions_total", {"provider": req.provider, "model": req.model, "type": type(e).__name__})
+            finally:
+                self.active -= 1
+
+    async def _connect(self, req, labels):
+        host, _, port = req.host.partition(':')
+        port = int(port) if port else (443 if req.secure else 80)
+        started = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=_ssl_context() if req.secure else None),
+            CONNECTION_TIMEOUT_SEC)
+        if self.metrics and labels:
+            self.metrics.observe("ai_answers_upstream_connect_seconds", time.perf_counter() - started, labels)
+        return reader, writer
+
+    def _acquire(self, key):
+        # Idle keep-alive connections live on the loop thread only, so no lock is needed
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer, idle_since = idle.pop()
+            # The loop has already processed anything the server sent: a closed or EOF'd stream is stale
+            if time.monotonic() - idle_since <= self.max_idle and not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _release(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) >= self.pool_size:
+            writer.close()
+        else:
+            idle.append((reader, writer, time.monotonic()))
+
+    def pool_stats(self):
+        return {f"{'https' if secure else 'http'}://{host}": len(idle) for (secure, host), idle in list(self._idle.items())}
+
+    async def prewarm(self, host, secure):
+        # Same policy as ConnectionPool.prewarm, for connections of this loop
+        key = (secure, host)
+        now = time.monotonic()
+        idle = []
+        for reader, writer, idle_since in self._idle.get(key, []):
+            if now - idle_since <= self.max_idle and not writer.is_closing() and not reader.at_eof():
+                idle.append((reader, writer, idle_since))
+            else:
+                writer.close()
+        self._idle[key] = idle
+        if any(now - idle_since < self.max_idle / 2 for _, _, idle_since in idle):
+            return 0.0
+        started = time.perf_counter()
+        conn = await self._connect(UpstreamRequest(None, secure, host, None, None, None, None, None, None), None)
+        self._release(key, *conn)
+        return time.perf_counter() - started
+
+    async def _exchange(self, req, reader, writer):
+        body = req.body.encode('utf-8')
+        head = f"POST {req.path} HTTP/1.1\r\nHost: {req.host}\r\nContent-Length: {len(body)}\r\n"
+        head += "".join(f"{k}: {v}\r\n" for k, v in req.headers.items())
+        writer.write(head.encode('latin-1') + b"\r\n" + body)
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), CONNECTION_TIMEOUT_SEC)
+        if not status_line:
+            raise ConnectionResetError("upstream closed the connection")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), CONNECTION_TIMEOUT_SEC)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    async def _fetch(self, req, emit):
+        labels = {"provider": req.provider, "model": req.model}
+        key = (req.secure, req.host)
+        conn = self._acquire(key)
+        reused = conn is not None
+        if reused:
+            if self.metrics:
+                self.metrics.observe("ai_answers_upstream_connect_seconds", 0.0, labels)
+        else:
+            conn = await self._connect(req, labels)
+        reader, writer = conn
+        # Set once the response has been read to its end, so the connection can be reused
+        body_state = {"complete": False}
+        headers = {}
+        try:
+            try:
+                status, headers = await self._exchange(req, reader, writer)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                # The server dropped a pooled connection while it sat idle
+                writer.close()
+                reader, writer = await self._connect(req, labels)
+                status, headers = await self._exchange(req, reader, writer)
+
+            if self.metrics:
+                self.metrics.inc("ai_answers_upstream_responses_total", dict(labels, status=status))
+            body_chunks = self._body(reader, headers, body_state)
+            if status != 200:
+                error = b"".join([chunk async for chunk in body_chunks])
+                logger.error(f"{req.label} API Error {status}: {error.decode('utf-8', 'replace')}")
+                return None
+            parser = STREAM_PARSERS[req.protocol]()
+            async for chunk in body_chunks:
+                for text in parser.feed(chunk):
+                    emit(text)
+                if parser.done:
+                    _record_usage(self.metrics, labels, parser.usage)
+                    await self._drain(body_chunks)
+                    return True
+        finally:
+            if body_state["complete"] and headers.get('connection', '').lower() != 'close':
+                self._release(key, reader, writer)
+            else:
+                # Abandoned, cancelled or unframed responses leave unread bytes behind
+                writer.close()
+
+    @staticmethod
+    async def _drain(body_chunks):
+        # Read the tail after a terminal event (e.g. SSE [DONE]) so the connection can be reused
+        async def rest():
+            async for _ in body_chunks:
+                pass
+        try:
+            await asyncio.wait_for(rest(), 1.0)
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+
+    async def _body(self, reader, headers, state):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await asyncio.wait_for(reader.readline(), CONNECTION_TIMEOUT_SEC)).split(b";")[0], 16)
+                if size == 0:
+                    # Trailers, if any, end with an empty line
+                    while (await asyncio.wait_for(reader.readline(), CONNECTION_TIMEOUT_SEC)) not in (b"\r\n", b"\n", b""):
+                        pass
+                    state["complete"] = True
+                    return
+                yield await asyncio.wait_for(reader.readexactly(size), CONNECTION_TIMEOUT_SEC)
+                await reader.readline()
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining > 0:
+                chunk = await asyncio.wait_for(reader.read(min(remaining, 65536)), CONNECTION_TIMEOUT_SEC)
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+            state["complete"] = True
+        else:
+            # Delimited by the server closing the connection, which therefore cannot be reused
+            while True:
+                chunk = await asyncio.wait_for(reader.read(65536), CONNECTION_TIMEOUT_SEC)
+                if not chunk:
+                    return
+                yield chunk
+
+
+class _Flight:
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+        self.done = False
+        self.ok = None
+        self.pumping = False
+        self.subscribers = 0
+        self.cond = threading.Condition()
+
+
+class SingleFlight:
+    # Coalesces identical in-flight answers within a worker. There is no dedicated producer:
+    # whichever subscriber runs out of buffered chunks pulls the next one from upstream,
+    # so the stream survives any single subscriber leaving and is closed when the last one does.
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def stream(self, key, start):
+        # A generator itself, so a response that is never iterated never joins a flight
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight(start())
+            else:
+                self.coalesced += 1
+            flight.subscribers += 1
+        return (yield from self._follow(key, flight))
+
+    def _follow(self, key, flight):
+        seen = 0
+        try:
+            while True:
+                with flight.cond:
+                    while seen >= len(flight.chunks) and not flight.done and flight.pumping:
+                        flight.cond.wait()
+                    if seen < len(flight.chunks):
+                        chunk = flight.chunks[seen]
+                        seen += 1
+                    elif flight.done:
+                        return flight.ok
+                    else:
+                        chunk = None
+                        flight.pumping = True
+                if chunk is not None:
+                    yield chunk
+                    continue
+                self._pump(key, flight)
+        finally:
+            with self._lock:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+                if abandoned and self._flights.get(key) is flight:
+                    del self._flights[key]
+            if abandoned:
+                flight.stream.close()
+
+    def _pump(self, key, flight):
+        done, ok, chunk = False, None, None
+        try:
+            chunk = next(flight.stream)
+        except StopIteration as stop:
+            done, ok = True, stop.value
+        except Exception as e:
+            logger.error(f"AI Answers shared stream failed: {e}")
+            done = True
+        finally:
+            if done:
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+            with flight.cond:
+                flight.pumping = False
+                if done:
+                    flight.done, flight.ok = True, ok
+                elif chunk is not None:
+                    flight.chunks.append(chunk)
+                flight.cond.notify_all()
+
+    def subscribers(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            return flight.subscribers if flight else 0
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "coalesced": self.coalesced}
+
+_TAG_RE = re.compile(r'<[^>]*>')
+_WORD_RE = re.compile(r'\w+')
+_NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)*')
+
+
+def _estimate_tokens(text):
+    # ~4 characters per token for English BPE vocabularies; cheap and close enough for budgeting
+    return (len(text) + 3) // 4
+
+
+def _clean_text(text):
+    return " ".join(html.unescape(_TAG_RE.sub(' ', str(text or ''))).split())
+
+
+def _shingles(text):
+    words = _WORD_RE.findall(text.casefold())
+    return {tuple(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+
+class ContextBuilder:
+    # Turns ranked search results into a prompt context of predictable size: cleans HTML and
+    # whitespace, drops empty and (near-)duplicate snippets, caps each result and packs them
+    # greedily in rank order until the token budget is spent.
+
+    def __init__(self, budget, result_tokens, max_results, dup_threshold):
+        self.budget = budget
+        self.result_tokens = result_tokens
+        self.max_results = max_results
+        self.dup_threshold = dup_threshold
+        self._lock = threading.Lock()
+        self._stats = {"built": 0, "tokens": 0, "max_tokens": 0, "results": 0, "duplicates": 0, "empty": 0, "truncated": 0, "build_ms_total": 0.0}
+
+    def _truncate(self, text, tokens):
+        limit = tokens * 4
+        if len(text) <= limit:
+            return text, False
+        cut = text.rfind(' ', 0, limit)
+        return text[:cut if cut > limit // 2 else limit].rstrip() + "…", True
+
+    def build(self, results):
+        started = time.perf_counter()
+        kept, seen = [], []
+        used = duplicates = empty = truncated = 0
+        # Look a little past max_results so dropped duplicates can be backfilled
+        for r in results[:self.max_results * 2]:
+            if len(kept) >= self.max_results or used >= self.budget:
+                break
+            title = _clean_text(r.get('title'))
+            content = _clean_text(r.get('content'))
+            if not content and not title:
+                empty += 1
+                continue
+            shingles = _shingles(f"{title} {content}")
+            if any(len(shingles & other) / len(shingles | other) >= self.dup_threshold for other in seen):
+                duplicates += 1
+                continue
+            room = min(self.result_tokens, self.budget - used)
+            if kept and room < 32:
+                # Not worth a stub; the top results already carry the answer
+                break
+            entry, cut = self._truncate(f"[{len(kept) + 1}] {title}: {content}", room)
+            truncated += cut
+            seen.append(shingles)
+            kept.append(entry)
+            used += _estimate_tokens(entry)
+        context = "\n".join(kept)
+
+        with self._lock:
+            stats = self._stats
+            stats["built"] += 1
+            stats["tokens"] += used
+            stats["max_tokens"] = max(stats["max_tokens"], used)
+            stats["results"] += len(kept)
+            stats["duplicates"] += duplicates
+            stats["empty"] += empty
+            stats["truncated"] += truncated
+            stats["build_ms_total"] += (time.perf_counter() - started) * 1000
+        return context
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["avg_tokens"] = round(stats["tokens"] / stats["built"], 1) if stats["built"] else 0
+        return stats
+
+
+class SemanticIndex:
+    # Approximate answer reuse for paraphrased searches, per worker. Each entry keeps the answer
+    # key of a search, its query as a unit vector of hashed character trigrams and the hashes of
+    # its top result URLs. A lookup only scores entries that share a URL: the URL overlap
+    # (set cosine) and the query cosine are computed for all of them in one batch, and both must
+    # pass their thresholds. Trigrams barely tell "3.11" from "3.12", so the numbers in the two
+    # queries must also be the same. Entries are overwritten oldest first once capacity is reached.
+
+    def __init__(self, capacity, query_threshold, url_threshold, dims=256, max_urls=6):
+        self.capacity = capacity
+        self.query_threshold = query_threshold
+        self.url_threshold = url_threshold
+        self.dims = dims
+        self.max_urls = max_urls
+        self.queries = np.zeros((capacity, dims), dtype=np.float32)
+        self.urls = np.zeros((capacity, max_urls), dtype=np.int64)
+        self.url_counts = np.zeros(capacity, dtype=np.int64)
+        self.keys = [None] * capacity
+        self.numbers = [None] * capacity
+        self._by_url = {}
+        self._next = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "matches": 0}
+
+    def embed(self, query):
+        text = f" {' '.join(_WORD_RE.findall(query.casefold()))} "
+        # crc32 rather than hash(): string hashes are salted per process, which would make similarity
+        # between two queries depend on the worker's random seed
+        vec = np.bincount([zlib.crc32(text[i:i + 3].encode()) % self.dims for i in range(len(text) - 2)], minlength=self.dims).astype(np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def numbers_in(self, query):
+        return frozenset(_NUMBER_RE.findall(query))
+
+    def url_hashes(self, results):
+        urls = {r.get('url') for r in results[:self.max_urls] if r.get('url')}
+        # 0 pads unused URL slots, so no real URL may hash to it
+        return np.array([hash(u) or 1 for u in urls], dtype=np.int64)
+
+    def add(self, key, query_vec, url_hashes, numbers=frozenset()):
+        if not len(url_hashes):
+            return
+        with self._lock:
+            slot = self._next
+            self._next = (slot + 1) % self.capacity
+            if self.keys[slot] is None:
+                self._size += 1
+            else:
+                for h in self.urls[slot, :self.url_counts[slot]].tolist():
+                    slots = self._by_url.get(h)
+                    slots.discard(slot)
+                    if not slots:
+                        del self._by_url[h]
+            self.keys[slot] = key
+            self.numbers[slot] = numbers
+            self.queries[slot] = query_vec
+            self.urls[slot] = 0
+            self.urls[slot, :len(url_hashes)] = url_hashes
+            self.url_counts[slot] = len(url_hashes)
+            for h in url_hashes.tolist():
+                self._by_url.setdefault(h, set()).add(slot)
+
+    def lookup(self, query_vec, url_hashes, numbers=frozenset(), limit=3):
+        # Answer keys of the closest passing entries, best first
+        if not len(url_hashes):
+            return []
+        with self._lock:
+            self._stats["lookups"] += 1
+            # A passing entry shares at least url_threshold² · len(url_hashes) URLs with this search,
+            # so all but that many minus one URLs suffice to find it: skip the most common ones
+            postings = sorted((self._by_url.get(h, ()) for h in url_hashes.tolist()), key=len)
+            needed = max(1, math.ceil(self.url_threshold ** 2 * len(url_hashes) - 1e-9))
+            candidates = set().union(*postings[:len(postings) - needed + 1])
+            if not candidates:
+                return []
+            slots = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            shared = np.isin(self.urls[slots], url_hashes).sum(axis=1)
+            url_sim = shared / np.sqrt(self.url_counts[slots] * len(url_hashes))
+            slots = slots[url_sim >= self.url_threshold]
+            query_sim = self.queries[slots] @ query_vec
+            passing = query_sim >= self.query_threshold
+            slots, query_sim = slots[passing], query_sim[passing]
+            ranked = slots[np.argsort(-query_sim)].tolist()
+            keys = [self.keys[i] for i in ranked if self.numbers[i] == numbers][:limit]
+        return keys
+
+    def record_match(self):
+        with self._lock:
+            self._stats["matches"] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=self._size)
+
+
+def _releasing(stream, release):
+    # Passes a generation through and frees its admission slot when it ends, however it ends
+    try:
+        return (yield from stream)
+    finally:
+        release()
+
+
+class Prefetcher:
+    # Starts answers speculatively from post_search, before the browser asks for them.
+    # Each generation is pumped by a short-lived thread as the only subscriber of a single-flight
+    # entry, so /ai-stream simply attaches to it. The thread steps back once a real request joins,
+    # pauses when its buffer is full, and cancels the generation if nobody claims it in time.
+    # An admission slot taken for it is held until the generation itself ends, since a request
+    # that joins it takes none of its own. The thread may be blocked waiting for a first token
+    # when the claim window closes, so a timer stops the upstream through its abort.
+
+    def __init__(self, flights, max_concurrent, claim_sec, max_chunks):
+        self.flights = flights
+        self.max_concurrent = max_concurrent
+        self.claim_sec = claim_sec
+        self.max_chunks = max_chunks
+        self.active = 0
+        self.counters = {"started": 0, "skipped": 0, "claimed": 0, "finished": 0, "expired": 0}
+        self._finished = {}
+        self._lock = threading.Lock()
+
+    def start(self, key, start, release=None, abort=None):
+        with self._lock:
+            self._expire()
+            if self.active >= self.max_concurrent or key in self._finished or self.flights.subscribers(key):
+                self.counters["skipped"] += 1
+                if release:
+                    release()
+                return False
+            self.active += 1
+            self.counters["started"] += 1
+        threading.Thread(target=self._run, args=(key, start, release, abort), name="ai-answers-prefetch", daemon=True).start()
+        return True
+
+    def skip(self):
+        with self._lock:
+            self.counters["skipped"] += 1
+
+    def _run(self, key, start, release=None, abort=None):
+        deadline = time.monotonic() + self.claim_sec
+        started = []
+        timer = None
+        if abort:
+            timer = threading.Timer(self.claim_sec, lambda: self.flights.subscribers(key) > 1 or abort())
+            timer.daemon = True
+            timer.start()
+
+        def begin():
+            started.append(True)
+            return _releasing(start(), release) if release else start()
+
+        stream = self.flights.stream(key, begin)
+        parts = []
+        outcome = "expired"
+        try:
+            while time.monotonic() < deadline:
+                if self.flights.subscribers(key) > 1:
+                    outcome = "claimed"
+                    break
+                if len(parts) >= self.max_chunks:
+                    time.sleep(0.05)
+                    continue
+                try:
+                    parts.append(next(stream))
+                except StopIteration as stop:
+                    if stop.value:
+                        # Finished before anyone asked: hold the answer for the rest of the claim window
+                        with self._lock:
+                            self._finished[key] = ("".join(parts), deadline)
+                        outcome = "finished"
+                    break
+        except Exception as e:
+            logger.error(f"AI Answers prefetch failed: {e}")
+        finally:
+            if timer:
+                timer.cancel()
+            stream.close()
+            if release and not started:
+                # Joined a generation someone else started, so the slot was never used
+                release()
+            with self._lock:
+                self.active -= 1
+                self.counters[outcome] += 1
+
+    def claim(self, key):
+        with self._lock:
+            self._expire()
+            entry = self._finished.pop(key, None)
+        return entry[0] if entry else None
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [k for k, (_, deadline) in self._finished.items() if deadline < now]:
+            del self._finished[key]
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, active=self.active, unclaimed=len(self._finished))
+
+
+class _BackendHealth:
+    def __init__(self):
+        self.ttft = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+
+
+class Router:
+    # Latency-aware routing over an ordered set of backends. Backends are ranked by EWMA
+    # time-to-first-token weighted by EWMA error rate; repeated failures open a circuit for a
+    # while. A request that fails before its first token fails over to the next backend, and
+    # one with no first token after hedge_after starts the next backend in parallel; the first
+    # to produce a token wins and the others are cancelled.
+
+    ALPHA = 0.3
+
+    def __init__(self, backends, engine, hedge_after, failure_threshold, open_sec):
+        self.backends = backends
+        self.engine = engine
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.open_sec = open_sec
+        self.health = {b.name: _BackendHealth() for b in backends}
+        self.hedged = 0
+        self._lock = threading.Lock()
+
+    def order(self):
+        now = time.monotonic()
+        with self._lock:
+            available = [b for b in self.backends if self.health[b.name].open_until <= now]
+            def score(item):
+                rank, b = item
+                h = self.health[b.name]
+                # Untried backends score as if they answered at the hedge threshold
+                ttft = h.ttft if h.ttft is not None else (self.hedge_after or 1.0)
+                return (ttft * (1 + 4 * h.error_rate), rank)
+            ranked = [b for _, b in sorted(enumerate(available), key=score)]
+        # With every circuit open, still try them in configured order rather than fail outright
+        return ranked or list(self.backends)
+
+    def _record(self, backend, ok, ttft=None):
+        with self._lock:
+            h = self.health[backend.name]
+            h.requests += 1
+            if ttft is not None:
+                h.ttft = ttft if h.ttft is None else self.ALPHA * ttft + (1 - self.ALPHA) * h.ttft
+            h.error_rate = self.ALPHA * (0.0 if ok else 1.0) + (1 - self.ALPHA) * h.error_rate
+            if ok:
+                h.failures = 0
+            else:
+                h.failures += 1
+                if h.failures >= self.failure_threshold:
+                    h.open_until = time.monotonic() + self.open_sec
+                    logger.warning(f"AI Answers router: circuit open for {backend.name} after {h.failures} failures")
+
+    def _sample(self, backend, ttft):
+        # Latency only: leaves error rate and the consecutive failure count alone
+        with self._lock:
+            h = self.health[backend.name]
+            h.ttft = ttft if h.ttft is None else self.ALPHA * ttft + (1 - self.ALPHA) * h.ttft
+
+    def stream(self, prompt, abort=None, idle_sec=None):
+        chunks = queue.SimpleQueue()
+        future = self.engine.submit(self._route(prompt, chunks.put))
+        if abort:
+            abort.set(lambda: (future.cancel(), chunks.put(_StreamEnd(None))))
+        try:
+            return (yield from _from_queue(chunks, idle_sec))
+        finally:
+            future.cancel()
+
+    async def _route(self, prompt, emit):
+        ok = None
+        try:
+            ok = await self.route(prompt, emit)
+        finally:
+            emit(_StreamEnd(ok))
+
+    async def route(self, prompt, emit):
+        pending = self.order()
+        running = {}
+        winner = None
+        first_token = asyncio.Event()
+
+        def launch():
+            backend = pending.pop(0)
+            started = time.monotonic()
+
+            def on_text(text):
+                nonlocal winner
+                if winner is None:
+                    winner = backend
+                    self._record(backend, True, time.monotonic() - started)
+                    first_token.set()
+                    for task, (other, other_started) in running.items():
+                        if other is not backend:
+                            task.cancel()
+                            # A hedged-out backend was at least this slow; a latency sample, not a success
+                            self._sample(other, time.monotonic() - other_started)
+                if winner is backend:
+                    emit(text)
+
+            task = asyncio.ensure_future(self.engine.run(backend.request(prompt), on_text))
+            running[task] = (backend, started)
+
+        try:
+            launch()
+            while winner is None and running:
+                hedge = self.hedge_after if pending and self.hedge_after > 0 else None
+                waiter = asyncio.ensure_future(first_token.wait())
+                done, _ = await asyncio.wait(set(running) | {waiter}, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if winner is not None:
+                    break
+                failed = [task for task in done if task in running]
+                for task in failed:
+                    backend, _ = running.pop(task)
+                    self._record(backend, False)
+                if pending and (failed or not done):
+                    if not done:
+                        self.hedged += 1
+                    launch()
+
+            if winner is None:
+                return None
+            ok = await next(task for task, (backend, _) in running.items() if backend is winner)
+            if not ok:
+                # Broke mid-answer; too late to fail over, but it counts against the backend
+                self._record(winner, False)
+            return ok
+        finally:
+            # Client went away or a winner was chosen: nothing else may keep streaming
+            for task in running:
+                task.cancel()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            backends = {
+                name: {
+                    "ttft_ewma_s": round(h.ttft, 4) if h.ttft is not None else None,
+                    "error_rate": round(h.error_rate, 4),
+                    "requests": h.requests,
+                    "circuit": "open" if h.open_until > now else "closed",
+                }
+                for name, h in self.health.items()
+            }
+        return {"hedged": self.hedged, "backends": backends}
+
+
+class HeavyHitters:
+    # Bounded top-k query counter (Space-Saving with batched pruning). Counts are exact until
+    # twice the capacity of distinct queries is tracked; then only the capacity most frequent are
+    # kept, and a query first seen afterwards starts at the highest count dropped so far, which is
+    # also recorded as its possible error. The latest context of each tracked query is kept with it.
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.floor = 0
+        self.observed = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def observe(self, query, context):
+        key = _normalize_query(query)
+        with self._lock:
+            self.observed += 1
+            entry = self._entries.get(key)
+            if entry:
+                entry[0] += 1
+                entry[2:] = query, context
+                return
+            self._entries[key] = [self.floor + 1, self.floor, query, context]
+            if len(self._entries) > 2 * self.capacity:
+                ranked = sorted(self._entries.items(), key=lambda item: item[1][0], reverse=True)
+                self.floor = max(self.floor, ranked[self.capacity][1][0])
+                self._entries = dict(ranked[:self.capacity])
+
+    def top(self, n):
+        # (query, context, count) by guaranteed count, most frequent first
+        with self._lock:
+            entries = heapq.nlargest(n, self._entries.values(), key=lambda e: e[0] - e[1])
+        return [(query, context, count) for count, _, query, context in entries]
+
+    def stats(self):
+        with self._lock:
+            return {"observed": self.observed, "tracked": len(self._entries), "floor": self.floor}
+
+
+def _in_window(window, now):
+    # "HH:MM-HH:MM" in local time; the window may wrap past midnight
+    start, _, end = window.partition('-')
+    start, end = (datetime.time.fromisoformat(t.strip()) for t in (start, end))
+    t = now.time()
+    return start <= t < end if start <= end else (t >= start or t < end)
+
+
+class Precomputer:
+    # Generates answers for the most frequent queries ahead of demand, using the context each
+    # was last searched with, so they come straight from the answer cache. Runs on demand or
+    # inside an off-peak window; the shared lease lets only one worker run per interval.
+    # Starts are paced at rate_per_min and at most `concurrency` generations run at once.
+
+    def __init__(self, sketch, cached, generate, top_n, concurrency, rate_per_min, window, lease):
+        self.sketch = sketch
+        self.cached = cached
+        self.generate = generate
+        self.top_n = top_n
+        self.concurrency = concurrency
+        self.rate_per_min = rate_per_min
+        self.window = window
+        self.lease = lease
+        self.last_run = None
+        self._running = threading.Lock()
+        if window:
+            _in_window(window, datetime.datetime.now())  # fail on a malformed window at startup
+
+    def start(self):
+        if self.window:
+            threading.Thread(target=self._schedule, name="ai-answers-precompute", daemon=True).start()
+
+    def _schedule(self):
+        while True:
+            time.sleep(60)
+            if _in_window(self.window, datetime.datetime.now()) and self.lease and self.lease.claim("precompute"):
+                self.run()
+
+    def run_in_background(self):
+        if self._running.locked():
+            return False
+        threading.Thread(target=self.run, name="ai-answers-precompute-run", daemon=True).start()
+        return True
+
+    def run(self):
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            jobs = self.sketch.top(self.top_n)
+            run = {"started": int(time.time()), "queries": len(jobs), "outcomes": collections.Counter()}
+            self.last_run = run
+            gap = 60.0 / self.rate_per_min if self.rate_per_min > 0 else 0
+            lock = threading.Lock()
+
+            def one(query, context):
+                try:
+                    outcome = self.generate(query, context)
+                except Exception as e:
+                    logger.error(f"AI Answers precompute of '{query}' failed: {e}")
+                    outcome = "failed"
+                with lock:
+                    run["outcomes"][outcome] += 1
+
+            with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+                paced = False
+                for query, context, _ in jobs:
+                    # Answers that are still cached cost nothing, so they do not use up pacing time
+                    if self.cached(query, context):
+                        run["outcomes"]["cached"] += 1
+                        continue
+                    if paced and gap:
+                        time.sleep(gap)
+                    paced = True
+                    executor.submit(one, query, context)
+            run["finished"] = int(time.time())
+            return run
+        finally:
+            self._running.release()
+
+    def stats(self):
+        run = self.last_run
+        return {
+            "running": self._running.locked(),
+            "sketch": self.sketch.stats(),
+            "last_run": dict(run, outcomes=dict(run["outcomes"])) if run else None,
+        }
+
+
+class _TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        # A caller may have read the clock before this bucket was created
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+
+class AdmissionControl:
+    # Per-worker admission for new upstream generations: a global and per-provider cap on open
+    # streams, a short bounded wait queue with a deadline, and token buckets per client and per
+    # provider quota. admit() either returns a slot or rejects at once with a reason; only a
+    # request that got a place in the queue waits, and never longer than queue_wait.
+
+    MAX_CLIENTS = 10000
+
+    def __init__(self, max_streams, provider_streams, queue_size, queue_wait, client_rate, client_burst, provider_rates, metrics=None):
+        self.metrics = metrics
+        self.max_streams = max_streams
+        self.provider_streams = provider_streams
+        self.queue_size = queue_size
+        self.queue_wait = queue_wait
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.provider_buckets = {p: _TokenBucket(rate / 60.0, rate) for p, rate in provider_rates.items() if rate > 0}
+        self.active = collections.Counter()
+        self.waiting = 0
+        self.rejected = collections.Counter()
+        self._clients = {}
+        self._cond = threading.Condition()
+
+    def allow_client(self, client):
+        # Per-client request rate; applies to every /ai-stream request, cached answers included
+        if self.client_rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._cond:
+            bucket = self._clients.get(client)
+            if bucket is None:
+                if len(self._clients) >= self.MAX_CLIENTS:
+                    # Full buckets carry no state worth keeping
+                    self._clients = {c: b for c, b in self._clients.items() if b.refill(now) < b.burst}
+                bucket = self._clients[client] = _TokenBucket(self.client_rate / 60.0, self.client_burst)
+            allowed = bucket.refill(now) >= 1
+            if allowed:
+                bucket.tokens -= 1
+            else:
+                self.rejected["client_rate"] += 1
+        if not allowed:
+            self._count_rejection("client_rate", None)
+        return allowed
+
+    def _has_room(self, provider):
+        limit = self.provider_streams.get(provider, 0)
+        return ((self.max_streams <= 0 or sum(self.active.values()) < self.max_streams)
+                and (limit <= 0 or self.active[provider] < limit))
+
+    def admit(self, provider, wait=True):
+        # Returns (release, None) or (None, reason). Speculative work passes wait=False: it never
+        # queues, and being turned away is not counted as a rejection. Metrics are written after
+        # leaving the lock, since a write may flush to SQLite.
+        reason = self._try_admit(provider, wait)
+        if reason == "queued":
+            self._count_queued(1)
+            try:
+                reason = self._wait_admit(provider)
+            finally:
+                self._count_queued(-1)
+        if reason:
+            if wait:
+                self._count_rejection(reason, provider)
+            return None, reason
+
+        released = []
+        def release():
+            with self._cond:
+                if not released:
+                    released.append(True)
+                    self.active[provider] -= 1
+                    # Waiters may be held by different provider caps, so wake them all to re-check
+                    self._cond.notify_all()
+        return release, None
+
+    def _try_admit(self, provider, wait):
+        # Takes a slot at once (None), takes a place in the queue ("queued") or rejects (the reason)
+        with self._cond:
+            bucket = self.provider_buckets.get(provider)
+            if bucket and bucket.refill(time.monotonic()) < 1:
+                return self._reject("provider_rate", wait)
+            if not self._has_room(provider):
+                if not wait or self.waiting >= self.queue_size:
+                    return self._reject("overloaded", wait)
+                self.waiting += 1
+                return "queued"
+            return self._take(provider, bucket, wait)
+
+    def _wait_admit(self, provider):
+        deadline = time.monotonic() + self.queue_wait
+        with self._cond:
+            try:
+                while not self._has_room(provider):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return self._reject("queue_timeout", True)
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            # The quota may have been spent while this request was queued
+            return self._take(provider, self.provider_buckets.get(provider), True)
+
+    def _take(self, provider, bucket, wait):
+        if bucket:
+            if bucket.refill(time.monotonic()) < 1:
+                return self._reject("provider_rate", wait)
+            bucket.tokens -= 1
+        self.active[provider] += 1
+        return None
+
+    def _reject(self, reason, counted):
+        # Under the lock: the counter only; the metric is written by the caller after leaving it
+        if counted:
+            self.rejected[reason] += 1
+        return reason
+
+    def _count_rejection(self, reason, provider):
+        if self.metrics:
+            self.metrics.inc("ai_answers_admission_rejections_total", {"reason": reason, "provider": provider} if provider else {"reason": reason})
+
+    def _count_queued(self, delta):
+        if self.metrics:
+            self.metrics.inc("ai_answers_admission_queued", {}, delta)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active": sum(self.active.values()),
+                "active_by_provider": {p: n for p, n in self.active.items() if n},
+                "queued": self.waiting,
+                "rejected": dict(self.rejected),
+            }
+
+
+def _shutdown(sock):
+    try:
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def _peer_closed(sock):
+    # Readable with nothing to peek at means the client closed its end
+    try:
+        if not select.select([sock], [], [], 0)[0]:
+            return False
+        return not sock.recv(1, socket.MSG_PEEK)
+    except ValueError:
+        # Closed by the server in the meantime, or a socket that cannot be peeked (TLS): no verdict
+        return False
+    except OSError:
+        return True
+
+
+def _wait_readable(res, sock, timeout):
+    # Whether more of a streaming response arrives within timeout. Bytes already in the response's
+    # read buffer, or decrypted but unread TLS data, are invisible to select: a non-blocking peek
+    # finds those, and pulls in whatever the socket already has. A finished response reads as ready.
+    if res.fp is None or sock is None:
+        return True
+    saved = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        buffered = res.fp.peek()
+    except ssl.SSLWantReadError:
+        buffered = b""
+    finally:
+        sock.settimeout(saved)
+    # A chunked read often leaves just the CRLF that closes the chunk behind
+    if buffered.strip() if res.chunked else buffered:
+        return True
+    if isinstance(sock, ssl.SSLSocket) and sock.pending():
+        return True
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+class _Abort:
+    # Lets another thread stop an upstream stream that is blocked waiting for data. The stream
+    # registers how to stop itself once it has something to stop; firing earlier runs it on registration.
+
+    def __init__(self):
+        self.fired = False
+        self._fn = None
+        self._lock = threading.Lock()
+
+    def set(self, fn):
+        with self._lock:
+            self._fn = fn
+            fired = self.fired
+        if fired:
+            fn()
+
+    def __call__(self):
+        with self._lock:
+            if self.fired:
+                return
+            self.fired = True
+            fn = self._fn
+        if fn:
+            fn()
+
+
+class DisconnectWatcher:
+    # Notices /ai-stream clients that went away without waiting for the next write to fail, which
+    # during a long upstream silence may be much later. One thread per worker checks every watched
+    # response each interval: a closed client socket (when the WSGI server exposes it) or a cancel
+    # flag set by the widget's beacon on another worker. A beacon that reaches this worker fires at once.
+
+    def __init__(self, interval, cancels=None, metrics=None):
+        self.interval = interval
+        self.cancels = cancels
+        self.metrics = metrics
+        self.counters = {"disconnect": 0, "beacon": 0}
+        self._watched = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def watch(self, token, sock, on_gone):
+        entry = (token, sock, on_gone)
+        with self._lock:
+            # Start lazily so every forked worker gets its own thread
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._watched = {}
+                threading.Thread(target=self._run, name="ai-answers-disconnects", daemon=True).start()
+            self._watched[id(entry)] = entry
+        return lambda: self._unwatch(id(entry))
+
+    def _unwatch(self, entry_id):
+        with self._lock:
+            return self._watched.pop(entry_id, None)
+
+    def cancel(self, token):
+        with self._lock:
+            matches = [i for i, (t, _, _) in self._watched.items() if t == token]
+        for entry_id in matches:
+            self._fire(entry_id, "beacon")
+        return bool(matches)
+
+    def _fire(self, entry_id, reason):
+        entry = self._unwatch(entry_id)
+        if entry is None:
+            return
+        self.counters[reason] += 1
+        if self.metrics:
+            self.metrics.inc("ai_answers_cancelled_total", {"reason": reason})
+        try:
+            entry[2]()
+        except Exception as e:
+            logger.error(f"AI Answers cancel failed: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = list(self._watched.items())
+            for entry_id, (token, sock, _) in watched:
+                if sock is not None and _peer_closed(sock):
+                    self._fire(entry_id, "disconnect")
+                elif self.cancels and self.cancels.contains(token):
+                    self._fire(entry_id, "beacon")
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, watched=len(self._watched))
+
+
+class _SQLiteFile:
+    # One SQLite file on local disk, shared by every gunicorn/uwsgi worker on the host
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        # Connections are per thread and per process (never reuse one inherited across fork)
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+
+class SharedStore(_SQLiteFile):
+    # Key/value table with TTL + LRU + byte-size eviction, shared across workers. Row and byte totals
+    # are kept up to date by triggers in the counters table, so a write only touches the oldest
+    # entries when a cap is actually exceeded.
+
+    def __init__(self, path, table, ttl, max_bytes, max_entries):
+        super().__init__(path)
+        self.table = table
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        db = self._db()
+        db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)")
+        db.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)")
+        db.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)")
+        db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+        self._create_totals(db)
+
+    def _create_totals(self, db):
+        # Seeded from the table in the same transaction that creates the triggers, so rows written
+        # before (by an older version or another worker) are counted exactly once
+        table = self.table
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if not db.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?", (f"{table}_totals_insert",)).fetchone():
+                bump = ("INSERT INTO counters (name, value) VALUES ('{table}.entries', {rows}), ('{table}.bytes', {size}) "
+                        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value")
+                db.execute(f"CREATE TRIGGER {table}_totals_insert AFTER INSERT ON {table} BEGIN "
+                           f"{bump.format(table=table, rows=1, size='NEW.size')}; END")
+                db.execute(f"CREATE TRIGGER {table}_totals_delete AFTER DELETE ON {table} BEGIN "
+                           f"{bump.format(table=table, rows=-1, size='-OLD.size')}; END")
+                db.execute(f"CREATE TRIGGER {table}_totals_update AFTER UPDATE OF size ON {table} BEGIN "
+                           f"{bump.format(table=table, rows=0, size='NEW.size - OLD.size')}; END")
+                entries, used = db.execute(f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {table}").fetchone()
+                db.executemany("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)",
+                               ((f"{table}.entries", entries), (f"{table}.bytes", used)))
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            db.execute("ROLLBACK")
+            raise
+
+    def get(self, key):
+        try:
+            db = self._db()
+            row = db.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row and now - row[1] <= self.ttl:
+                db.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (now, key))
+                self.incr("hits")
+                return row[0]
+            if row:
+                db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self.incr("misses")
+        except sqlite3.Error as e:
+            logger.warning(f"AI Answers store '{self.table}' read failed: {e}")
+        return None
+
+    def contains(self, key):
+        # Existence check that leaves LRU order and hit/miss counters alone
+        try:
+            row = self._db().execute(f"SELECT created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return False
+        return bool(row) and time.time() - row[0] <= self.ttl
+
+    def peek(self, key):
+        # Like get, but leaves LRU order and hit/miss counters alone
+        try:
+            row = self._db().execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row and time.time() - row[1] <= self.ttl else None
+
+    def put(self, key, value, ttl=None):
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        try:
+            db = self._db()
+            now = time.time()
+            # Expiry is created + self.ttl, so a different lifetime is stored as a shifted creation time
+            created = now + (ttl - self.ttl if ttl else 0)
+            # An upsert rather than INSERT OR REPLACE: REPLACE's implicit delete does not fire triggers
+            db.execute(f"INSERT INTO {self.table} (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?) "
+                       "ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+                       "created = excluded.created, accessed = excluded.accessed", (key, value, size, created, now))
+            self._evict(db, now)
+        except sqlite3.Error as e:
+            logger.warning(f"AI Answers store '{self.table}' write failed: {e}")
+
+    def claim(self, key):
+        # Insert-if-absent across workers: True for exactly one caller until the entry expires
+        try:
+            db = self._db()
+            now = time.time()
+            db.execute(f"DELETE FROM {self.table} WHERE key = ? AND created < ?", (key, now - self.ttl))
+            return db.execute(f"INSERT OR IGNORE INTO {self.table} (key, value, size, created, accessed) VALUES (?, '', 0, ?, ?)", (key, now, now)).rowcount == 1
+        except sqlite3.Error as e:
+            logger.warning(f"AI Answers store '{self.table}' claim failed: {e}")
+            return False
+
+    def _evict(self, db, now):
+        db.execute(f"DELETE FROM {self.table} WHERE created < ?", (now - self.ttl,))
+        totals = dict(db.execute("SELECT name, value FROM counters WHERE name IN (?, ?)",
+                                 (f"{self.table}.entries", f"{self.table}.bytes")).fetchall())
+        extra_rows = totals.get(f"{self.table}.entries", 0) - self.max_entries
+        extra_bytes = totals.get(f"{self.table}.bytes", 0) - self.max_bytes
+        if extra_rows <= 0 and extra_bytes <= 0:
+            return
+        # Drop the least recently used entries, walking the accessed index only as far as needed
+        victims = []
+        oldest = db.execute(f"SELECT key, size FROM {self.table} ORDER BY accessed")
+        for key, size in oldest:
+            if extra_rows <= 0 and extra_bytes <= 0:
+                break
+            victims.append((key,))
+            extra_rows -= 1
+            extra_bytes -= size
+        oldest.close()
+        db.executemany(f"DELETE FROM {self.table} WHERE key = ?", victims)
+
+    def incr(self, name, amount=1):
+        self._db().execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (f"{self.table}.{name}", amount))
+
+    def stats(self):
+        try:
+            db = self._db()
+            counters = dict(db.execute("SELECT name, value FROM counters WHERE name LIKE ?", (f"{self.table}.%",)).fetchall())
+        except sqlite3.Error as e:
+            logger.warning(f"AI Answers store '{self.table}' stats failed: {e}")
+            return {}
+        stats = {"entries": 0, "bytes": 0}
+        stats.update({name.split('.', 1)[1]: value for name, value in counters.items()})
+        return stats
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists but belongs to someone else
+        return True
+    return True
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+class Metrics(_SQLiteFile):
+    # Prometheus-style counters, gauges and histograms aggregated across workers. Each worker
+    # accumulates deltas in memory and adds them to a shared SQLite table at most every
+    # flush_interval seconds (and at the end of every answer), so a scrape of any worker sees all.
+    # Gauges are kept per process instead: each worker stores its current values under its pid,
+    # and a scrape sums the live processes, so a killed worker cannot leave a gauge off for good.
+
+    SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    FAMILIES = {
+        "ai_answers_context_build_seconds": ("histogram", "Time to build the prompt context in post_search", SECONDS),
+        "ai_answers_context_tokens": ("histogram", "Estimated prompt context tokens", (100, 250, 500, 1000, 1500, 2000, 4000, 8000)),
+        "ai_answers_upstream_connect_seconds": ("histogram", "Upstream connect + TLS time (0 for pooled connections)", SECONDS),
+        "ai_answers_ttft_seconds": ("histogram", "Time from starting the upstream request to the first token", SECONDS),
+        "ai_answers_stream_seconds": ("histogram", "Total upstream stream duration", SECONDS),
+        "ai_answers_tokens_per_second": ("histogram", "Streamed deltas per second after the first token", (1, 5, 10, 20, 50, 100, 200, 500)),
+        "ai_answers_tokens_total": ("counter", "Streamed text deltas", None),
+        "ai_answers_bytes_total": ("counter", "Streamed answer bytes", None),
+        "ai_answers_frames_total": ("counter", "Response frames after coalescing deltas", None),
+        "ai_answers_upstream_responses_total": ("counter", "Upstream HTTP responses by status code", None),
+        "ai_answers_upstream_exceptions_total": ("counter", "Upstream exceptions by type", None),
+        "ai_answers_streams_total": ("counter", "Upstream streams by outcome (completed, failed, aborted)", None),
+        "ai_answers_streams_in_flight": ("gauge", "Upstream streams currently open", None),
+        "ai_answers_responses_total": ("counter", "/ai-stream responses by source (cache, prefetch, stream)", None),
+        "ai_answers_admission_rejections_total": ("counter", "/ai-stream requests rejected by admission control, by reason", None),
+        "ai_answers_admission_queued": ("gauge", "Requests waiting for a stream slot", None),
+        "ai_answers_cancelled_total": ("counter", "Streams stopped because the client left, by how it was noticed (disconnect, beacon)", None),
+        "ai_answers_prompt_tokens_total": ("counter", "Prompt tokens reported by the provider", None),
+        "ai_answers_cached_prompt_tokens_total": ("counter", "Prompt tokens the provider served from its prompt/KV cache", None),
+    }
+
+    def __init__(self, path, flush_interval=1.0):
+        super().__init__(path)
+        self.flush_interval = flush_interval
+        self._pending = collections.Counter()
+        self._gauges = collections.Counter()
+        self._last_flush = time.monotonic()
+        self._flushing = False
+        self._lock = threading.Lock()
+        db = self._db()
+        db.execute("CREATE TABLE IF NOT EXISTS metrics (family TEXT, sample TEXT, labels TEXT, value REAL, PRIMARY KEY (family, sample, labels))")
+        db.execute("CREATE TABLE IF NOT EXISTS gauges (pid INTEGER, family TEXT, labels TEXT, value REAL, PRIMARY KEY (pid, family, labels))")
+        # Gauges were once stored as summed deltas in the metrics table
+        gauges = [family for family, (kind, _, _) in self.FAMILIES.items() if kind == "gauge"]
+        db.execute(f"DELETE FROM metrics WHERE family IN ({','.join('?' * len(gauges))})", gauges)
+        self._forget_gauges()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The parent's pending deltas and gauge values are its own to report
+        self._lock = threading.Lock()
+        self._pending = collections.Counter()
+        self._gauges = collections.Counter()
+        self._flushing = False
+        self._forget_gauges()
+
+    def _forget_gauges(self, own=True):
+        # Drops rows of processes that are gone and, at start-up, those of this pid's previous owner
+        try:
+            db = self._db()
+            pids = {pid for (pid,) in db.execute("SELECT DISTINCT pid FROM gauges")}
+            dead = [(pid,) for pid in pids if (own and pid == os.getpid()) or not _pid_alive(pid)]
+            db.executemany("DELETE FROM gauges WHERE pid = ?", dead)
+        except sqlite3.Error as e:
+            logger.warning(f"AI Answers metrics gauge cleanup failed: {e}")
+
+    @staticmethod
+    def _labels(labels):
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+        return ",".join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items()))
+
+    def inc(self, family, labels, amount=1):
+        with self._lock:
+            if self.FAMILIES[family][0] == "gauge":
+                self._gauges[(family, self._labels(labels))] += amount
+            else:
+                self._pending[(family, family, self._labels(labels))] += amount
+        self._maybe_flush()
+
+    def observe(self, family, value, labels):
+        buckets = self.FAMILIES[family][2]
+        base = self._labels(labels)
+        sep = "," if base else ""
+        with self._lock:
+            # Buckets are stored cumulatively, as exposed
+            for le in buckets:
+                # Adding 0 still creates the sample, so every bucket is exposed
+                self._pending[(family, f"{family}_bucket", f'{base}{sep}le="{le}"')] += 1 if value <= le else 0
+            self._pending[(family, f"{family}_bucket", f'{base}{sep}le="+Inf"')] += 1
+            self._pending[(family, f"{family}_sum", base)] += value
+            self._pending[(family, f"{family}_count", base)] += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush < self.flush_interval:
+            return
+        if not _in_event_loop():
+            self.flush()
+            return
+        # Never block the asyncio engine's loop on SQLite; flush from a short-lived thread instead
+        with self._lock:
+            if self._flushing:
+                return
+            self._flushing = True
+        threading.Thread(target=self._flush_in_background, name="ai-answers-metrics", daemon=True).start()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            self._flushing = False
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, collections.Counter()
+            gauges = list(self._gauges.items())
+            self._last_flush = time.monotonic()
+        if not pending and not gauges:
+            return
+        try:
+            db = self._db()
+            with db:
+                db.execute("BEGIN")
+                db.executemany(
+                    "INSERT INTO metrics (family, sample, labels, value) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(family, sample, labels) DO UPDATE SET value = value + excluded.value",
+                    [(family, sample, labels, value) for (family, sample, labels), value in pending.items()])
+                db.executemany(
+                    "INSERT OR REPLACE INTO gauges (pid, family, labels, value) VALUES (?, ?, ?, ?)",
+                    [(os.getpid(), family, labels, value) for (family, labels), value in gauges])
+        except sqlite3.Error as e:
+            logger.warning(f"AI Answers metrics flush failed: {e}")
+
+    def render(self):
+        self.flush()
+        self._forget_gauges(own=False)
+        try:
+            db = self._db()
+            rows = db.execute("SELECT family, sample, labels, value FROM metrics").fetchall()
+            rows += db.execute("SELECT family, family, labels, SUM(value) FROM gauges GROUP BY family, labels").fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"AI Answers metrics read failed: {e}")
+            rows = []
+        samples = collections.defaultdict(list)
+        for family, sample, labels, value in rows:
+            samples[family].append((sample, labels, value))
+        lines = []
+        for family, (kind, help_text, buckets) in self.FAMILIES.items():
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {kind}")
+            # Per label set: buckets in ascending le order, then _count and _sum
+            rank = {str(le): i for i, le in enumerate(list(buckets or ()) + ["+Inf"])}
+            groups = collections.defaultdict(list)
+            for sample, labels, value in samples.get(family, []):
+                base, order = labels, len(rank)
+                if sample.endswith("_bucket"):
+                    base, _, le = labels.rpartition('le=')
+                    base, order = base.rstrip(','), rank.get(le.strip('"'), len(rank))
+                groups[base].append((order, sample, labels, value))
+            for base in sorted(groups):
+                for _, sample, labels, value in sorted(groups[base]):
+                    value = int(value) if float(value).is_integer() else round(value, 6)
+                    lines.append(f"{sample}{{{labels}}} {value}" if labels else f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Warmup:
+    # Pays the first answer's setup costs in the background: DNS, the CA bundle and a TCP/TLS
+    # connection parked where answers will pick it up (the router engine's pool with several
+    # backends, the blocking pool otherwise), and a one-token completion that loads the model for
+    # local backends. Local backends are refreshed every refresh_sec so the model stays loaded;
+    # remote ones every half pool idle time, so a usable connection is always parked. restart()
+    # runs it again in a forked worker.
+
+    def __init__(self, backends, pool, refresh_sec, engine=None):
+        self.backends = backends
+        self.pool = pool
+        self.engine = engine
+        self.refresh_sec = refresh_sec
+        self.rounds = 0
+        self.status = {b.name: {"state": "pending"} for b in backends}
+        self._lock = threading.Lock()
+
+    def restart(self):
+        # After a fork: the parent's thread and lock state stay behind
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        threading.Thread(target=self._run, name="ai-answers-warmup", daemon=True).start()
+
+    def _interval(self, backend):
+        if backend.is_local and backend.provider != 'gemini':
+            return self.refresh_sec
+        return min(self.refresh_sec, max(self.pool.max_idle / 2, 1.0))
+
+    def _run(self):
+        due = {b.name: 0.0 for b in self.backends}
+        while True:
+            for backend in self.backends:
+                if due[backend.name] <= time.monotonic():
+                    self._warm(backend)
+                    due[backend.name] = time.monotonic() + self._interval(backend)
+            with self._lock:
+                self.rounds += 1
+            if self.refresh_sec <= 0:
+                return
+            time.sleep(max(0.0, min(due.values()) - time.monotonic()))
+
+    def _prewarm(self, host, secure):
+        if self.engine:
+            return self.engine.submit(self.engine.prewarm(host, secure)).result(CONNECTION_TIMEOUT_SEC * 2)
+        return self.pool.prewarm(host, secure)
+
+    def _warm(self, backend):
+        started = time.perf_counter()
+        conn = res = None
+        try:
+            if backend.is_local and backend.provider != 'gemini':
+                req = backend.warmup_request()
+                conn, res = self.pool.request(req.host, req.secure, "POST", req.path, req.body, req.headers)
+                body = res.read()
+                if res.status != 200:
+                    raise RuntimeError(f"HTTP {res.status}: {body[:200].decode('utf-8', 'replace')}")
+                step = "model"
+                if self.engine:
+                    self._prewarm(req.host, req.secure)
+            else:
+                req = backend.request("")
+                host, _, port = req.host.partition(':')
+                socket.getaddrinfo(host, int(port) if port else (443 if req.secure else 80), type=socket.SOCK_STREAM)
+                if req.secure:
+                    _ssl_context()
+                self._prewarm(req.host, req.secure)
+                step = "connection"
+            status = {"state": "ready", "warmed": step}
+        except Exception as e:
+            logger.warning(f"AI Answers warm-up of {backend.name} failed: {e}")
+            status = {"state": "failed", "error": str(e)}
+        finally:
+            if conn:
+                self.pool.release(conn, res)
+        status["seconds"] = round(time.perf_counter() - started, 3)
+        status["at"] = int(time.time())
+        with self._lock:
+            self.status[backend.name] = status
+
+    @property
+    def ready(self):
+        # At least one backend warmed; a failed refresh of a local model makes it unready again
+        with self._lock:
+            return any(s["state"] == "ready" for s in self.status.values())
+
+    def stats(self):
+        with self._lock:
+            return {"ready": any(s["state"] == "ready" for s in self.status.values()), "rounds": self.rounds, "backends": {name: dict(s) for name, s in self.status.items()}}
+
+
+# Fixed instructions, sent ahead of the per-search context and query as a byte-identical leading prefix
+# on every request, so providers that reuse KV cache or discount cached prompt tokens can skip its prefill
+SYSTEM_PROMPT = (
+    "Answer USER QUERY by integrating SEARCH RESULTS with expert knowledge.\n"
+    "HIERARCHY: Use RESULTS for facts/data. Use KNOWLEDGE for context/synthesis.\n"
+    "CONSTRAINTS: <4 sentences | Dense information | Complete thoughts.\n"
+    "FALLBACK: If results are empty, answer from knowledge but note the lack of sources."
+)
+
+
+def _user_prompt(context, query):
+    # The variable part of the prompt; context blocks come from ContextBuilder in rank order
+    return f"SEARCH RESULTS:\n{context}\n\nUSER QUERY: {query}\n\nANSWER:"
+
+
+class Backend:
+    # One configured LLM endpoint; builds the upstream request spec for its provider's protocol.
+    # Everything in the request body before the user message is serialized once here.
+
+    def __init__(self, provider, model, api_key, base_url, max_tokens, temperature, name=None, cache_control=False):
+        self.provider = provider
+        self.model = model
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.name = name or (f"{provider}:{model}" if provider == 'gemini' else f"{provider}:{model}@{base_url}")
+        # Support HTTP for localhost/Ollama
+        self.is_local = base_url.startswith('localhost') or base_url.startswith('127.')
+        if cache_control and provider != 'gemini':
+            # Explicit breakpoint for providers that only cache marked prefixes (Anthropic models via OpenRouter)
+            self.system_message = {"role": "system", "content": [
+                {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]}
+        else:
+            self.system_message = {"role": "system", "content": SYSTEM_PROMPT}
+        if provider == 'gemini':
+            # Gemma models on the Gemini API reject systemInstruction, so the instructions are the first part of the turn
+            config = {"maxOutputTokens": max_tokens, "temperature": temperature}
+            self._body_prefix = (f'{{"generationConfig": {json.dumps(config)}, '
+                                 f'"contents": [{{"role": "user", "parts": [{json.dumps({"text": SYSTEM_PROMPT})}, ')
+            self._body_suffix = ']}]}'
+        else:
+            # stream_options.include_usage makes the last chunk carry token counts, including cached ones
+            options = {"model": model, "stream": True, "stream_options": {"include_usage": True},
+                       "max_tokens": max_tokens, "temperature": temperature}
+            self._body_prefix = f'{json.dumps(options)[:-1]}, "messages": [{json.dumps(self.system_message)}, '
+            self._body_suffix = ']}'
+
+    def request(self, prompt):
+        if self.provider == 'openai':
+            return self.openai_request(prompt)
+        elif self.provider == 'openrouter':
+            return self.openrouter_request(prompt)
+        elif self.provider == 'gemini':
+            return self.gemini_request(prompt)
+
+    def body(self, prompt):
+        if self.provider == 'gemini':
+            return self._body_prefix + json.dumps({"text": prompt}) + self._body_suffix
+        return self._body_prefix + json.dumps({"role": "user", "content": prompt}) + self._body_suffix
+
+    def warmup_request(self):
+        # One-token, non-streaming completion: makes a local OpenAI-compatible server (Ollama) load
+        # the model and restarts its unload timer, for the cost of a single token. It starts with the
+        # same system message, so the server also has the shared prefix cached.
+        req = self.request("")
+        payload = {"model": self.model, "messages": [self.system_message, {"role": "user", "content": "hi"}], "max_tokens": 1, "stream": False}
+        return req._replace(body=json.dumps(payload))
+
+    def gemini_request(self, prompt):
+        host = self.base_url
+        path = f"/v1/models/{self.model}:streamGenerateContent?key={self.api_key}"
+        return UpstreamRequest("Gemini", not self.is_local, host, path, self.body(prompt), {"Content-Type": "application/json"}, "json-array", self.provider, self.model)
+
+    def openrouter_request(self, prompt):
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://github.com/searxng/searxng",
+            "X-Title": "SearXNG LLM Plugin"
+        }
+        # Ollama uses /v1/... while OpenRouter uses /api/v1/...
+        api_path = "/v1/chat/completions" if self.is_local else "/api/v1/chat/completions"
+        return UpstreamRequest("OpenRouter", not self.is_local, self.base_url, api_path, self.body(prompt), headers, "sse", self.provider, self.model)
+
+    def openai_request(self, prompt):
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://github.com/searxng/searxng",
+            "X-Title": "SearXNG LLM Plugin",
+        }
+        # Open WebUI serves its OpenAI-compatible API under /api/
+        return UpstreamRequest("OpenAI (openwebui)", False, self.base_url, "/api/chat/completions", self.body(prompt), headers, "sse", self.provider, self.model)
+
+
+# Answer widget, served from /ai-static/<version>/ and cached by browsers; the per-search
+# placeholder only carries the query, token and (without the stash) the context as data attributes
+WIDGET_CSS = """
+@keyframes sxng-blink { 0%, 100% { opacity: 1; } 50% { opacity: 0; } }
+@keyframes sxng-pulse { 0%, 100% { opacity: 0.4; } 50% { opacity: 0.9; } }
+#sxng-stream-data { white-space: pre-wrap; color: var(--color-result-description); font-size: 0.95rem; }
+.sxng-cursor {
+    display: inline-block; width: 0.5rem; height: 1rem;
+    background: var(--color-result-description);
+    margin-left: 2px; vertical-align: middle;
+    animation: sxng-blink 1s step-end infinite;
+}
+.sxng-thinking {
+    color: var(--color-result-description);
+    font-style: italic;
+    animation: sxng-pulse 1.5s ease-in-out infinite;
+}
+"""
+
+WIDGET_JS = """
+(async () => {
+    const box = document.getElementById('sxng-stream-box');
+    if (!box) return;
+    const data = document.getElementById('sxng-stream-data');
+    const q = box.dataset.q;
+    const ctx = box.dataset.ctx;
+    const tk = box.dataset.tk;
+    const wrapper = box.closest('.answer');
+    if (wrapper) wrapper.style.display = 'none';
+
+    // Tell the server to stop generating when the answer is abandoned
+    let finished = false;
+    const cancel = () => {
+        if (finished) return;
+        finished = true;
+        navigator.sendBeacon('/ai-cancel', JSON.stringify({ q: q, tk: tk }));
+    };
+    window.addEventListener('pagehide', cancel);
+
+    try {
+        // Show "Thinking..." placeholder while waiting for LLM
+        data.innerHTML = '<span class="sxng-thinking">Thinking...</span>';
+        if (wrapper) wrapper.style.display = '';
+        box.style.display = 'block';
+
+        const controller = new AbortController();
+        const timeoutId = setTimeout(() => { cancel(); controller.abort(); }, 60000);
+
+        const res = await fetch('/ai-stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            // ctx is undefined when the context is stashed on the server, and then left out
+            body: JSON.stringify({ q: q, context: ctx, tk: tk }),
+            signal: controller.signal
+        });
+
+        clearTimeout(timeoutId);
+        if (!res.ok) { finished = true; if (wrapper) wrapper.remove(); else box.remove(); return; }
+
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        const cursor = document.createElement('span');
+        cursor.className = 'sxng-cursor';
+
+        let started = false;
+        while (true) {
+            const {done, value} = await reader.read();
+            if (done) break;
+
+            const chunk = decoder.decode(value);
+            if (chunk) {
+                let text = chunk;
+                if (!started) {
+                    text = text.replace(/^[\\s.,;:!?]+/, '');
+                    if (!text) continue;
+                    data.textContent = '';  // Clear "Thinking..."
+                    data.appendChild(cursor);
+                    started = true;
+                }
+                cursor.before(text);
+            }
+        }
+        finished = true;
+        cursor.remove();
+        data.textContent = data.textContent.trimEnd();
+        if (!started) { if (wrapper) wrapper.remove(); else box.remove(); }
+    } catch (e) { console.error(e); cancel(); if (wrapper) wrapper.remove(); else box.remove(); }
+})();
+"""
+
+WIDGET_ASSETS = {
+    "widget.css": ("text/css", WIDGET_CSS.encode('utf-8')),
+    "widget.js": ("text/javascript", WIDGET_JS.encode('utf-8')),
+}
+WIDGET_VERSION = hashlib.sha256(WIDGET_CSS.encode('utf-8') + WIDGET_JS.encode('utf-8')).hexdigest()[:12]
+
 
 class SXNGPlugin(Plugin):
     id = "ai_answers"
@@ -36,6 +2150,161 @@ class SXNGPlugin(Plugin):
         except ValueError:
             self.temperature = 0.2
         self.base_url = os.getenv('OPENROUTER_BASE_URL', 'openrouter.ai')
+        self.gemini_base_url = os.getenv('GEMINI_BASE_URL', 'generativelanguage.googleapis.com')
+        # Explicit prompt cache markers for providers that need them; off by default since strict
+        # OpenAI-compatible servers may reject the extra field
+        self.cache_control = os.getenv('PROMPT_CACHE_CONTROL', '').lower() in ('1', 'true', 'yes')
+        self.backend = Backend(self.provider, self.model, self.api_key,
+                               self.gemini_base_url if self.provider == 'gemini' else self.base_url,
+                               self.max_tokens, self.temperature, cache_control=self.cache_control)
+        self.backends = [self.backend]
+        # Optional ordered backend set for routing, e.g.
+        # [{"provider": "gemini", "model": "gemma-3-27b-it", "api_key": "..."}, {"provider": "openrouter", "base_url": "localhost:11434", "model": "gemma3:27b"}]
+        backends_cfg = os.getenv('LLM_BACKENDS')
+        if backends_cfg:
+            try:
+                self.backends = [self._backend_from_config(cfg) for cfg in json.loads(backends_cfg)] or self.backends
+            except (ValueError, TypeError, AttributeError) as e:
+                logger.error(f"AI Answers plugin: invalid LLM_BACKENDS, using {self.provider} only: {e}")
+            self.backend = self.backends[0]
+            self.provider, self.model = self.backend.provider, self.backend.model
+            self.api_key, self.base_url = self.backend.api_key, self.backend.base_url
+        self.context_builder = ContextBuilder(
+            _env_int('CONTEXT_TOKEN_BUDGET', 1200),
+            _env_int('CONTEXT_RESULT_TOKENS', 300),
+            _env_int('CONTEXT_MAX_RESULTS', 6),
+            _env_float('CONTEXT_DUP_THRESHOLD', 0.8))
+        store_path = os.getenv('ANSWER_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'sxng_ai_answers.sqlite3'))
+        # Prometheus metrics aggregated across workers in the shared SQLite file; METRICS=0 disables
+        self.metrics = None
+        if os.getenv('METRICS', '1').lower() not in ('0', 'false', 'no'):
+            try:
+                self.metrics = Metrics(store_path)
+            except sqlite3.Error as e:
+                logger.error(f"AI Answers plugin: metrics disabled: {e}")
+        self.pool = ConnectionPool(_env_int('UPSTREAM_POOL_SIZE', 8), _env_float('UPSTREAM_POOL_IDLE_SEC', 30))
+        # Several backends: route by latency/health with failover and hedging. Racing and cancelling
+        # streams needs them on one asyncio loop thread per worker rather than in the request thread.
+        self.router = None
+        if len(self.backends) > 1:
+            self.router = Router(
+                self.backends,
+                AsyncStreamEngine(_env_int('ROUTER_CONCURRENCY', 256), self.metrics, self.pool.max_per_host, self.pool.max_idle),
+                _env_float('ROUTER_HEDGE_AFTER_SEC', 2.0),
+                _env_int('ROUTER_FAILURE_THRESHOLD', 3),
+                _env_float('ROUTER_OPEN_SEC', 30))
+        # Identical concurrent requests share one upstream generation; SINGLE_FLIGHT=0 disables
+        self.single_flight = SingleFlight() if os.getenv('SINGLE_FLIGHT', '1').lower() not in ('0', 'false', 'no') else None
+        # Opt-in speculative generation from post_search; claims go through single-flight, so it is forced on
+        self.prefetcher = None
+        if os.getenv('SPECULATIVE_PREFETCH', '').lower() in ('1', 'true', 'yes'):
+            if not self.single_flight:
+                self.single_flight = SingleFlight()
+            self.prefetcher = Prefetcher(
+                self.single_flight,
+                _env_int('PREFETCH_MAX_CONCURRENT', 4),
+                _env_float('PREFETCH_CLAIM_SEC', 10),
+                _env_int('PREFETCH_MAX_CHUNKS', 2048))
+        # Finished answers, shared by all workers; ANSWER_CACHE_TTL_SEC=0 disables
+        self.answer_cache = None
+        cache_ttl = _env_int('ANSWER_CACHE_TTL_SEC', 3600)
+        if cache_ttl > 0:
+            try:
+                self.answer_cache = SharedStore(
+                    store_path, 'answers', cache_ttl,
+                    _env_int('ANSWER_CACHE_MAX_BYTES', 32 * 1024 * 1024),
+                    _env_int('ANSWER_CACHE_MAX_ENTRIES', 10000))
+            except sqlite3.Error as e:
+                logger.error(f"AI Answers plugin: answer cache disabled: {e}")
+        # Opt-in background warm-up started from init(); WARMUP_REFRESH_SEC keeps a local model loaded
+        self.warmup = None
+        if os.getenv('WARMUP', '').lower() in ('1', 'true', 'yes'):
+            self.warmup = Warmup(self.backends, self.pool, _env_float('WARMUP_REFRESH_SEC', 240),
+                                 self.router.engine if self.router else None)
+        # Opt-in answers for the most frequent queries, generated on demand or in an off-peak window
+        self.precomputer = None
+        top_n = _env_int('PRECOMPUTE_TOP_N', 0)
+        if top_n > 0:
+            if not self.answer_cache:
+                logger.error("AI Answers plugin: PRECOMPUTE_TOP_N needs the answer cache, disabled")
+            else:
+                interval = _env_int('PRECOMPUTE_INTERVAL_SEC', 86400)
+                self.precompute_ttl = _env_int('PRECOMPUTE_TTL_SEC', max(interval, cache_ttl))
+                try:
+                    lease = SharedStore(store_path, 'jobs', interval, 1024 * 1024, 100)
+                    self.precomputer = Precomputer(
+                        HeavyHitters(max(top_n, _env_int('PRECOMPUTE_SKETCH_SIZE', 1000))),
+                        lambda q, context: self.answer_cache.contains(_answer_key(self.provider, self.model, q, context)),
+                        self._precompute_one,
+                        top_n,
+                        _env_int('PRECOMPUTE_CONCURRENCY', 2),
+                        _env_float('PRECOMPUTE_RATE_PER_MIN', 10),
+                        os.getenv('PRECOMPUTE_WINDOW', ''),
+                        lease)
+                except (sqlite3.Error, ValueError) as e:
+                    logger.error(f"AI Answers plugin: precompute disabled: {e}")
+        self.precompute_token = os.getenv('PRECOMPUTE_TOKEN', '')
+        # Opt-in reuse of answers to paraphrased searches with overlapping results; needs numpy and the answer cache
+        self.semantic = None
+        if os.getenv('SEMANTIC_REUSE', '').lower() in ('1', 'true', 'yes'):
+            if np is None or not self.answer_cache:
+                logger.error("AI Answers plugin: SEMANTIC_REUSE needs numpy and the answer cache, disabled")
+            else:
+                self.semantic = SemanticIndex(
+                    _env_int('SEMANTIC_MAX_ENTRIES', 20000),
+                    _env_float('SEMANTIC_QUERY_THRESHOLD', 0.9),
+                    _env_float('SEMANTIC_URL_THRESHOLD', 0.6),
+                    max_urls=self.context_builder.max_results)
+        # Search contexts stay on the server, keyed by the signed token; CONTEXT_STASH=0 round-trips them through the page
+        self.context_stash = None
+        if os.getenv('CONTEXT_STASH', '1').lower() not in ('0', 'false', 'no'):
+            try:
+                self.context_stash = SharedStore(
+                    store_path, 'contexts', TOKEN_EXPIRY_SEC + 5,
+                    _env_int('CONTEXT_STASH_MAX_BYTES', 16 * 1024 * 1024),
+                    _env_int('CONTEXT_STASH_MAX_ENTRIES', 20000))
+            except sqlite3.Error as e:
+                logger.error(f"AI Answers plugin: context stash disabled, contexts go through the page: {e}")
+        # Per-worker limits on new upstream generations and per-client request rates; ADMISSION=0 disables
+        self.admission = None
+        if os.getenv('ADMISSION', '1').lower() not in ('0', 'false', 'no'):
+            try:
+                provider_streams = json.loads(os.getenv('ADMISSION_PROVIDER_STREAMS') or '{}')
+                provider_rates = json.loads(os.getenv('PROVIDER_RATE_PER_MIN') or '{}')
+            except ValueError as e:
+                logger.error(f"AI Answers plugin: invalid admission limits, ignoring per-provider limits: {e}")
+                provider_streams, provider_rates = {}, {}
+            client_rate = _env_float('CLIENT_RATE_PER_MIN', 0)
+            self.admission = AdmissionControl(
+                _env_int('ADMISSION_MAX_STREAMS', 64),
+                provider_streams,
+                _env_int('ADMISSION_QUEUE_SIZE', 16),
+                _env_float('ADMISSION_QUEUE_WAIT_SEC', 2.0),
+                client_rate,
+                _env_float('CLIENT_BURST', max(client_rate / 6, 1)),
+                provider_rates,
+                self.metrics)
+        self.client_header = os.getenv('CLIENT_IP_HEADER', '')
+        # Abandoned streams are stopped within DISCONNECT_CHECK_SEC; 0 leaves it to the next failed write
+        self.watcher = None
+        self._aborts = weakref.WeakValueDictionary()
+        check_sec = _env_float('DISCONNECT_CHECK_SEC', 1.0)
+        if check_sec > 0:
+            cancels = None
+            try:
+                cancels = SharedStore(store_path, 'cancels', 300, 1024 * 1024, 10000)
+            except sqlite3.Error as e:
+                logger.error(f"AI Answers plugin: cancel beacons only reach the worker that receives them: {e}")
+            self.watcher = DisconnectWatcher(check_sec, cancels, self.metrics)
+        # Deltas are coalesced into frames of up to STREAM_FLUSH_CHARS or STREAM_FLUSH_MS; STREAM_FLUSH_MS=0 disables
+        self.flush_sec = _env_float('STREAM_FLUSH_MS', 40) / 1000
+        self.flush_chars = _env_int('STREAM_FLUSH_CHARS', 512)
+        # Per-search answer placeholder, filled with str.format in post_search
+        static = f"/ai-static/{WIDGET_VERSION}"
+        self.widget_template = (
+            '<article id="sxng-stream-box" class="answer" style="display:none; margin-bottom: 1rem;" data-q="{q}" data-tk="{tk}"{ctx}>'
+            f'<link rel="stylesheet" href="{static}/widget.css"><p id="sxng-stream-data"></p>'
+            f'<script src="{static}/widget.js" defer></script></article>')
         # Stable secret for multi-worker environments
         if self.api_key:
             self.secret = os.getenv('SXNG_LLM_SECRET') or hashlib.sha256(self.api_key.encode()).hexdigest()
@@ -44,305 +2313,451 @@ class SXNGPlugin(Plugin):
             logger.warning("AI Answers plugin: No API key configured, plugin will be inactive")
 
     def init(self, app):
+        # Background threads, started again in every forked worker; without a key there is nothing to warm or generate
+        if self.warmup and self.api_key:
+            # SearXNG startup does not wait on DNS, TLS or a model load
+            self.warmup.start()
+            os.register_at_fork(after_in_child=self.warmup.restart)
+        if self.precomputer and self.api_key:
+            self.precomputer.start()
+            os.register_at_fork(after_in_child=self.precomputer.start)
+
         @app.route('/ai-stream', methods=['POST'])
         def g_stream():
+            # Checked before the body is read and parsed; chunked bodies without a length are refused too
+            if self.context_stash and (request.content_length is None or request.content_length > STREAM_BODY_MAX_BYTES):
+                return Response("Error: Request Too Large", status=413)
             data = request.json or {}
             token = data.get('tk', '')
             q = data.get('q', '')
-            
-            try:
-                ts, sig = token.split('.', 1)
-                query_clean = q.strip()
-                expected = hashlib.sha256(f"{ts}{query_clean}{self.secret}".encode()).hexdigest()
-                if sig != expected or (time.time() - float(ts)) > TOKEN_EXPIRY_SEC:
-                    abort(403)
-            except (ValueError, KeyError, AttributeError):
+            if not self._verify_token(token, q, TOKEN_EXPIRY_SEC):
                 abort(403)
 
-            context_text = data.get('context', '')
             if not self.api_key or not q:
                 return Response("Error: Missing Key", status=400)
+            if self.admission and not self.admission.allow_client(self._client(request)):
+                return Response("Error: Rate Limited", status=429, headers={"Retry-After": "10"})
+            if self.context_stash:
+                context_text = self.context_stash.get(token)
+                if context_text is None:
+                    return Response("Error: Context Expired", status=410)
+            else:
+                context_text = data.get('context', '')
 
-            prompt = (
-                f"SYSTEM: Answer USER QUERY by integrating SEARCH RESULTS with expert knowledge.\n"
-                f"HIERARCHY: Use RESULTS for facts/data. Use KNOWLEDGE for context/synthesis.\n"
-                f"CONSTRAINTS: <4 sentences | Dense information | Complete thoughts.\n"
-                f"FALLBACK: If results are empty, answer from knowledge but note the lack of sources.\n\n"
-                f"SEARCH RESULTS:\n{context_text}\n\n"
-                f"USER QUERY: {q}\n\n"
-                f"ANSWER:"
-            )
-
-            def generate_gemini():
-                host = "generativelanguage.googleapis.com"
-                path = f"/v1/models/{self.model}:streamGenerateContent?key={self.api_key}"
-                conn = None
-                try:
-                    conn = http.client.HTTPSConnection(host, timeout=CONNECTION_TIMEOUT_SEC, context=ssl.create_default_context())
-                    payload = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": {"maxOutputTokens": self.max_tokens, "temperature": self.temperature}}
-                    conn.request("POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
-                    res = conn.getresponse()
-                    if res.status != 200:
-                        logger.error(f"Gemini API Error {res.status}: {res.read().decode('utf-8')}")
-                        return
+            cache_key = _answer_key(self.provider, self.model, q, context_text)
+            if self.answer_cache:
+                cached = self.answer_cache.get(cache_key)
+                if cached is not None:
+                    self._count_response("cache")
+                    return Response(iter([cached]), mimetype='text/event-stream', headers=STREAM_HEADERS)
 
-                    decoder = json.JSONDecoder()
-                    buffer = ""
-                    while True:
-                        chunk = res.read(128)
-                        if not chunk: break
-                        buffer += chunk.decode('utf-8')
-                        while buffer:
-                            buffer = buffer.lstrip()
-                            if not buffer: break
-                            try:
-                                obj, idx = decoder.raw_decode(buffer)
-                                candidates = obj.get('candidates', [])
-                                if candidates:
-                                    content = candidates[0].get('content', {})
-                                    parts = content.get('parts', [])
-                                    if parts:
-                                        text = parts[0].get('text', '')
-                                        if text: yield text
-                                buffer = buffer[idx:]
-                            except json.JSONDecodeError: break
-                except Exception as e:
-                    logger.error(f"Gemini Stream Exception: {e}")
-                finally:
-                    if conn: conn.close()
+            if self.prefetcher:
+                prefetched = self.prefetcher.claim(cache_key)
+                if prefetched is not None:
+                    self._count_response("prefetch")
+                    return Response(iter([prefetched]), mimetype='text/event-stream', headers=STREAM_HEADERS)
 
-            def generate_openrouter():
-                conn = None
-                try:
-                    # Support HTTP for localhost/Ollama
-                    is_local = self.base_url.startswith('localhost') or self.base_url.startswith('127.')
-                    if is_local:
-                        conn = http.client.HTTPConnection(self.base_url, timeout=CONNECTION_TIMEOUT_SEC)
+            release = None
+            # Joining a generation that is already running costs no upstream stream
+            if self.admission and not (self.single_flight and self.single_flight.subscribers(cache_key)):
+                release, reason = self.admission.admit(self._labels()["provider"])
+                if release is None:
+                    status = 429 if reason == "provider_rate" else 503
+                    return Response(f"Error: {reason}", status=status, headers={"Retry-After": "5"})
+
+            upstream = _Abort()
+            started = []
+
+            def start():
+                # The slot belongs to the generation, which may outlive this request when others join it
+                started.append(True)
+                self._aborts[cache_key] = upstream
+                stream = self._start_answer(q, context_text, cache_key, upstream)
+                return _releasing(stream, release) if release else stream
+
+            stream = self.single_flight.stream(cache_key, start) if self.single_flight else start()
+            self._count_response("stream")
+            response = Response(stream, mimetype='text/event-stream', headers=STREAM_HEADERS)
+            if release:
+                # Runs when the server closes the response. A shared generation started here frees the
+                # slot itself when it ends; otherwise the response ending is the generation ending, or
+                # it never started one (not iterated, or joined a flight started in the meantime).
+                response.call_on_close(lambda: None if self.single_flight and started else release())
+            if self.watcher:
+                def gone():
+                    # A generation shared with other live requests keeps running, and keeps its slot, for them
+                    if not self.single_flight:
+                        upstream()
+                    elif self.single_flight.subscribers(cache_key) <= 1:
+                        self._aborts.get(cache_key, upstream)()
                     else:
-                        conn = http.client.HTTPSConnection(self.base_url, timeout=CONNECTION_TIMEOUT_SEC, context=ssl.create_default_context())
-                    payload = {
-                        "model": self.model,
-                        "messages": [{"role": "user", "content": prompt}],
-                        "stream": True,
-                        "max_tokens": self.max_tokens,
-                        "temperature": self.temperature
-                    }
-                    headers = {
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json",
-                        "HTTP-Referer": "https://github.com/searxng/searxng",
-                        "X-Title": "SearXNG LLM Plugin"
-                    }
-                    # Ollama uses /v1/... while OpenRouter uses /api/v1/...
-                    api_path = "/v1/chat/completions" if is_local else "/api/v1/chat/completions"
-                    conn.request("POST", api_path, body=json.dumps(payload), headers=headers)
-                    res = conn.getresponse()
-                    if res.status != 200:
-                        logger.error(f"OpenRouter API Error {res.status}: {res.read().decode('utf-8')}")
                         return
+                    if release:
+                        release()
+                environ = request.environ
+                sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+                response.call_on_close(self.watcher.watch(token, sock, gone))
+            return response
 
-                    decoder = json.JSONDecoder()
-                    buffer = ""
-                    while True:
-                        chunk = res.read(128)
-                        if not chunk: break
-                        buffer += chunk.decode('utf-8')
-                        while "\n" in buffer:
-                            line, buffer = buffer.split("\n", 1)
-                            if line.startswith("data: "):
-                                data_str = line[6:].strip()
-                                if data_str == "[DONE]": return
-                                try:
-                                    obj, _ = decoder.raw_decode(data_str)
-                                    content = obj.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                                    if content: yield content
-                                except json.JSONDecodeError:
-                                    pass
-                except Exception as e:
-                    logger.error(f"OpenRouter Stream Exception: {e}")
-                finally:
-                    if conn: conn.close()
+        @app.route('/ai-cancel', methods=['POST'])
+        def g_cancel():
+            # navigator.sendBeacon from the widget on pagehide or timeout; the body arrives as text/plain
+            data = request.get_json(force=True, silent=True) or {}
+            token = data.get('tk', '')
+            if not self.watcher or not self._verify_token(token, data.get('q', ''), 600):
+                abort(404 if not self.watcher else 403)
+            if not self.watcher.cancel(token) and self.watcher.cancels:
+                # Streaming from another worker; its watcher picks the flag up on the next check
+                self.watcher.cancels.put(token, "1")
+            return Response(status=204)
 
-            def generate_openai():
-                conn = None
-                try:
-                    host = self.base_url
-                    headers = {
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json",
-                        "HTTP-Referer": "https://github.com/searxng/searxng",
-                        "X-Title": "SearXNG LLM Plugin",
-                    }
-                    # TODO: make more sense out of naming
-                    url = f"/api/chat/completions"
-
-                    payload = {
-                            "model": "llama3.2:latest", # TODO: Make modular
-                            "messages": [
-                                {
-                                    "role": "developer",
-                                    "content": "You are a helpful assistant."
-                                },
-                                {
-                                    "role": "user",
-                                    "content": "Hello!"
-                                }
-                                ]
-                            }
-
-
-
-                    payload = {
-                        "model": self.model,
-                        "messages": [{"role": "user", "content": prompt}],
-                        "stream": True,
-                        "max_tokens": self.max_tokens,
-                        "temperature": self.temperature
-                    }
-                    # TODO: Naming convention
-                    conn = http.client.HTTPConnection(self.base_url, timeout=CONNECTION_TIMEOUT_SEC)
-                    conn.request("POST", url, body=json.dumps(payload), headers=headers)
-                    res = conn.getresponse()
-
-                    decoder = json.JSONDecoder()
-                    buffer = ""
-                    while True:
-                        chunk = res.read(128)
-                        if not chunk: break
-                        buffer += chunk.decode('utf-8')
-                        while "\n" in buffer:
-                            line, buffer = buffer.split("\n", 1)
-                            if line.startswith("data: "):
-                                data_str = line[6:].strip()
-                                if data_str == "[DONE]": return
-                                try:
-                                    obj, _ = decoder.raw_decode(data_str)
-                                    content = obj.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                                    if content: yield content
-                                except json.JSONDecodeError:
-                                    pass
+        @app.route('/ai-static/<version>/<name>', methods=['GET'])
+        def g_static(version, name):
+            if name not in WIDGET_ASSETS:
+                abort(404)
+            mimetype, body = WIDGET_ASSETS[name]
+            response = Response(body, mimetype=mimetype)
+            if version == WIDGET_VERSION:
+                response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+            else:
+                # A page rendered before an upgrade: serve the current widget, but do not pin it to the old URL
+                response.headers['Cache-Control'] = 'no-cache'
+            response.set_etag(f"{WIDGET_VERSION}-{name}")
+            return response.make_conditional(request)
 
-                except Exception as e:
-                    logger.error(f"OpenAI (openwebui) Stream Exception: {e}")
-                    logger.error(f"HERE: url was {url}")
-                    
-                finally:
-                    if conn: conn.close()
-
-            if self.provider == 'openai':
-                generator = generate_openai
-            elif self.provider == 'openrouter':
-                generator = generate_openrouter
-            elif self.provider == 'gemini':
-                generator = generate_gemini
-            # generator = generate_openrouter if self.provider == 'openrouter' else generate_gemini
-            return Response(generator(), mimetype='text/event-stream', headers={
-                'X-Accel-Buffering': 'no',
-                'Cache-Control': 'no-cache, no-store',
-                'Connection': 'keep-alive',
-                'Content-Encoding': 'identity'
-            })
+        @app.route('/ai-metrics', methods=['GET'])
+        def g_metrics():
+            if not self.metrics:
+                abort(404)
+            return Response(self.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+        @app.route('/ai-precompute', methods=['POST'])
+        def g_precompute():
+            # On-demand run for cron jobs: Authorization: Bearer $PRECOMPUTE_TOKEN
+            if not self.precomputer or not self.precompute_token:
+                abort(404)
+            supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+            if not hmac.compare_digest(supplied.encode(), self.precompute_token.encode()):
+                abort(403)
+            if not self.precomputer.run_in_background():
+                return Response("already running", status=409, mimetype='text/plain')
+            return Response("started", status=202, mimetype='text/plain')
+
+        @app.route('/ai-ready', methods=['GET'])
+        def g_ready():
+            # For readiness probes: 503 until warm-up has reached a backend
+            if self.warmup and not self.warmup.ready:
+                return Response("warming up", status=503, mimetype='text/plain')
+            return Response("ready", mimetype='text/plain')
+
+        @app.route('/ai-stats', methods=['GET'])
+        def g_stats():
+            return {
+                "context": self.context_builder.stats(),
+                "answer_cache": self.answer_cache.stats() if self.answer_cache else None,
+                "context_stash": self.context_stash.stats() if self.context_stash else None,
+                "upstream_pool": self._pool_stats(),
+                "router_streams": self.router.engine.active if self.router else None,
+                "single_flight": self.single_flight.stats() if self.single_flight else None,
+                "prefetch": self.prefetcher.stats() if self.prefetcher else None,
+                "router": self.router.stats() if self.router else None,
+                "admission": self.admission.stats() if self.admission else None,
+                "cancelled": self.watcher.stats() if self.watcher else None,
+                "semantic_reuse": self.semantic.stats() if self.semantic else None,
+                "warmup": self.warmup.stats() if self.warmup else None,
+                "precompute": self.precomputer.stats() if self.precomputer else None,
+            }
         return True
 
+    def _sign(self, stamp, q):
+        # The separator keeps characters from moving between the nonce and the query
+        return hmac.new(self.secret.encode(), f"{stamp}\0{q.strip()}".encode(), hashlib.sha256).hexdigest()
+
+    def _verify_token(self, token, q, max_age):
+        try:
+            # "<ts>.<nonce>.<sig>", signed over everything before the signature
+            stamp, sig = token.rsplit('.', 1)
+            if '.' in stamp:
+                expected = self._sign(stamp, q)
+            else:
+                # "<ts>.<sig>" from pages rendered before the nonce was added
+                expected = hashlib.sha256(f"{stamp}{q.strip()}{self.secret}".encode()).hexdigest()
+            return hmac.compare_digest(sig, expected) and (time.time() - float(stamp.split('.', 1)[0])) <= max_age
+        except (ValueError, KeyError, AttributeError):
+            return False
+
+    def _client(self, req):
+        # Behind a reverse proxy, CLIENT_IP_HEADER (e.g. X-Real-IP) names the header holding the client address
+        if self.client_header:
+            forwarded = req.headers.get(self.client_header, '')
+            if forwarded:
+                return forwarded.split(',')[0].strip()
+        return req.remote_addr or ''
+
+    def _pool_stats(self):
+        # Idle keep-alive connections of the blocking pool and of the router's engine together
+        idle = collections.Counter(self.pool.stats())
+        if self.router:
+            idle.update(self.router.engine.pool_stats())
+        return dict(idle)
+
+    def _count_response(self, source):
+        if self.metrics:
+            self.metrics.inc("ai_answers_responses_total", dict(self._labels(), source=source))
+
+    def _backend_from_config(self, cfg):
+        provider = cfg.get('provider', 'openrouter').lower()
+        default_key = os.getenv('GEMINI_API_KEY') if provider == 'gemini' else os.getenv('OPENROUTER_API_KEY')
+        return Backend(
+            provider,
+            cfg.get('model', self.model),
+            cfg.get('api_key', default_key or self.api_key),
+            cfg.get('base_url', self.gemini_base_url if provider == 'gemini' else self.base_url),
+            int(cfg.get('max_tokens', self.max_tokens)),
+            float(cfg.get('temperature', self.temperature)),
+            cfg.get('name'),
+            bool(cfg.get('cache_control', self.cache_control)))
+
+    def _precompute_one(self, q, context_text):
+        # One precomputed answer, under the same admission limits as live traffic
+        key = _answer_key(self.provider, self.model, q, context_text)
+        release = None
+        if self.admission:
+            release, reason = self.admission.admit(self._labels()["provider"])
+            if release is None:
+                return reason
+        stream = self._start_answer(q, context_text, key, cache_ttl=self.precompute_ttl)
+        try:
+            while True:
+                next(stream)
+        except StopIteration as stop:
+            return "generated" if stop.value else "failed"
+        finally:
+            stream.close()
+            if release:
+                release()
+
+    def _reuse_similar(self, key, q, results):
+        # Copy the answer of a close enough earlier search to this search's key, so /ai-stream gets a plain cache hit
+        query_vec, url_hashes = self.semantic.embed(q), self.semantic.url_hashes(results)
+        numbers = self.semantic.numbers_in(q)
+        answer = None
+        for similar in self.semantic.lookup(query_vec, url_hashes, numbers):
+            # Not a get(): this search may never ask for its answer, so it is neither a hit nor a use
+            answer = self.answer_cache.peek(similar)
+            if answer is not None:
+                self.answer_cache.put(key, answer)
+                self.semantic.record_match()
+                break
+        self.semantic.add(key, query_vec, url_hashes, numbers)
+        return answer is not None
+
+    def _prefetch(self, q, context_text, cache_key):
+        # Speculative generations count against the same stream caps and provider quotas as live
+        # ones, but only take a slot that is free right now
+        release = None
+        if self.admission:
+            release, _ = self.admission.admit(self._labels()["provider"], wait=False)
+            if release is None:
+                self.prefetcher.skip()
+                return False
+        upstream = _Abort()
+        return self.prefetcher.start(cache_key, lambda: self._start_prefetch(q, context_text, cache_key, upstream), release, upstream)
+
+    def _start_prefetch(self, q, context_text, cache_key, upstream):
+        # Registered like a request's own generation, so a request that claims it can still stop it
+        self._aborts[cache_key] = upstream
+        return self._start_answer(q, context_text, cache_key, upstream)
+
+    def _start_answer(self, q, context_text, cache_key, abort=None, cache_ttl=None):
+        # The backends put SYSTEM_PROMPT in front of this
+        prompt = _user_prompt(context_text, q)
+
+        # Streams tick when the upstream pauses, so buffered text goes out on time
+        idle_sec = self.flush_sec if self.flush_sec > 0 else None
+        if self.router:
+            stream = self.router.stream(prompt, abort, idle_sec)
+        else:
+            req = self.backend.request(prompt)
+            stream = self._generate(req, abort, idle_sec)
+        if self.metrics:
+            stream = self._instrumented(stream, self._labels())
+        if self.answer_cache:
+            stream = self._caching(cache_key, stream, cache_ttl)
+        return self._coalescing(stream) if self.flush_sec > 0 else stream
+
+    def _labels(self):
+        return {"provider": "router", "model": "auto"} if self.router else {"provider": self.provider, "model": self.model}
+
+    def _instrumented(self, stream, labels):
+        started = time.perf_counter()
+        first = None
+        tokens = size = 0
+        outcome = "aborted"
+        self.metrics.inc("ai_answers_streams_in_flight", labels)
+        try:
+            while True:
+                try:
+                    chunk = next(stream)
+                except StopIteration as stop:
+                    outcome = "completed" if stop.value else "failed"
+                    return stop.value
+                if not chunk:
+                    # An idle tick, not text
+                    yield chunk
+                    continue
+                if first is None:
+                    first = time.perf_counter()
+                    self.metrics.observe("ai_answers_ttft_seconds", first - started, labels)
+                tokens += 1
+                size += len(chunk.encode('utf-8'))
+                yield chunk
+        finally:
+            stream.close()
+            now = time.perf_counter()
+            self.metrics.inc("ai_answers_streams_in_flight", labels, -1)
+            self.metrics.inc("ai_answers_streams_total", dict(labels, outcome=outcome))
+            self.metrics.observe("ai_answers_stream_seconds", now - started, labels)
+            self.metrics.inc("ai_answers_tokens_total", labels, tokens)
+            self.metrics.inc("ai_answers_bytes_total", labels, size)
+            if first is not None and tokens > 1 and now > first:
+                self.metrics.observe("ai_answers_tokens_per_second", (tokens - 1) / (now - first), labels)
+            self.metrics.flush()
+
+    def _caching(self, key, stream, ttl=None):
+        # Pass chunks through; store the full answer only if the provider finished cleanly
+        parts = []
+        try:
+            while True:
+                try:
+                    chunk = next(stream)
+                except StopIteration as stop:
+                    if stop.value and parts:
+                        self.answer_cache.put(key, "".join(parts), ttl)
+                    return stop.value
+                parts.append(chunk)
+                yield chunk
+        finally:
+            stream.close()
+
+    def _coalescing(self, stream):
+        # Merge small deltas into fewer response frames: the first text goes out at once (TTFT),
+        # later text when flush_chars have piled up or flush_sec has passed since the last frame.
+        # Deltas are pulled, so the window is checked as each one arrives and on the empty idle
+        # ticks the upstream streams yield when they pause.
+        parts = []
+        size = frames = 0
+        last = None
+        try:
+            while True:
+                try:
+                    chunk = next(stream)
+                except StopIteration as stop:
+                    if parts:
+                        frames += 1
+                        yield "".join(parts)
+                    return stop.value
+                now = time.monotonic()
+                if not chunk:
+                    if not parts or now - last < self.flush_sec:
+                        continue
+                else:
+                    parts.append(chunk)
+                    size += len(chunk)
+                if last is None or size >= self.flush_chars or now - last >= self.flush_sec:
+                    frames += 1
+                    last = now
+                    text = "".join(parts)
+                    parts, size = [], 0
+                    yield text
+        finally:
+            stream.close()
+            if self.metrics and frames:
+                self.metrics.inc("ai_answers_frames_total", self._labels(), frames)
+
+    def _generate(self, req, abort=None, idle_sec=None):
+        conn = res = None
+        labels = {"provider": req.provider, "model": req.model}
+        try:
+            conn, res = self.pool.request(req.host, req.secure, "POST", req.path, req.body, req.headers)
+            if abort:
+                # Shutting the socket down wakes the blocked read; the connection is then not reused
+                abort.set(lambda: _shutdown(conn.sock))
+            if self.metrics:
+                self.metrics.observe("ai_answers_upstream_connect_seconds", conn.connect_time, labels)
+                self.metrics.inc("ai_answers_upstream_responses_total", dict(labels, status=res.status))
+            if res.status != 200:
+                logger.error(f"{req.label} API Error {res.status}: {res.read().decode('utf-8', 'replace')}")
+                return
+
+            parser = STREAM_PARSERS[req.protocol]()
+            size = READ_MIN
+            pending = False
+            while True:
+                if pending and not _wait_readable(res, conn.sock, idle_sec):
+                    # The upstream paused after sending text: one idle tick, so coalescing can flush it
+                    pending = False
+                    yield ""
+                    continue
+                # read1 returns whatever has arrived, so small deltas are not held back
+                chunk = res.read1(size)
+                if not chunk: break
+                # Grow reads while the upstream keeps filling them, so long answers take fewer calls
+                if len(chunk) == size:
+                    size = min(size * 2, READ_MAX)
+                for text in parser.feed(chunk):
+                    pending = idle_sec is not None
+                    yield text
+                if parser.done:
+                    # The usage chunk precedes [DONE], so it has been parsed by now
+                    _record_usage(self.metrics, labels, parser.usage)
+                    self.pool.drain(conn, res)
+                    return True
+        except Exception as e:
+            logger.error(f"{req.label} Stream Exception: {e}")
+            if self.metrics:
+                self.metrics.inc("ai_answers_upstream_exceptions_total", dict(labels, type=type(e).__name__))
+        finally:
+            if conn: self.pool.release(conn, res)
+
     def post_search(self, request, search) -> EngineResults:
         results = EngineResults()
         try:
             if not self.active or not self.api_key or search.search_query.pageno > 1:
                 return results
 
+            started = time.perf_counter()
             raw_results = search.result_container.get_ordered_results()
-            context_list = [f"[{i+1}] {r.get('title')}: {r.get('content')}" for i, r in enumerate(raw_results[:6])]
-            context_str = "\n".join(context_list)
+            context_str = self.context_builder.build(raw_results)
+            if self.metrics:
+                self.metrics.observe("ai_answers_context_build_seconds", time.perf_counter() - started, self._labels())
+                self.metrics.observe("ai_answers_context_tokens", _estimate_tokens(context_str), self._labels())
 
-            # Stateless Handshake
-            ts = str(int(time.time()))
+            # Stateless Handshake. The nonce makes every search's token, and so its stash key, unique:
+            # the same query in the same second can come with other settings and other results.
+            stamp = f"{int(time.time())}.{secrets.token_hex(8)}"
             q_clean = search.search_query.query.strip()
-            sig = hashlib.sha256(f"{ts}{q_clean}{self.secret}".encode()).hexdigest()
-            tk = f"{ts}.{sig}"
-
-            b64_context = base64.b64encode(context_str.encode('utf-8')).decode('utf-8')
-            js_q = json.dumps(q_clean)
-
-            html_payload = f'''
-            <article id="sxng-stream-box" class="answer" style="display:none; margin-bottom: 1rem;">
-                <style>
-                    @keyframes sxng-blink {{ 0%, 100% {{ opacity: 1; }} 50% {{ opacity: 0; }} }}
-                    @keyframes sxng-pulse {{ 0%, 100% {{ opacity: 0.4; }} 50% {{ opacity: 0.9; }} }}
-                    .sxng-cursor {{ 
-                        display: inline-block; width: 0.5rem; height: 1rem; 
-                        background: var(--color-result-description); 
-                        margin-left: 2px; vertical-align: middle;
-                        animation: sxng-blink 1s step-end infinite;
-                    }}
-                    .sxng-thinking {{
-                        color: var(--color-result-description);
-                        font-style: italic;
-                        animation: sxng-pulse 1.5s ease-in-out infinite;
-                    }}
-                </style>
-                <p id="sxng-stream-data" style="white-space: pre-wrap; color: var(--color-result-description); font-size: 0.95rem;"></p>
-                <script>
-                (async () => {{
-                    const q = {js_q};
-                    const b64 = "{b64_context}";
-                    const tk = "{tk}";
-                    const box = document.getElementById('sxng-stream-box');
-                    const data = document.getElementById('sxng-stream-data');
-                    const wrapper = box.closest('.answer');
-                    if (wrapper) wrapper.style.display = 'none';
-                    
-                    try {{
-                        const ctx = new TextDecoder().decode(Uint8Array.from(atob(b64), c => c.charCodeAt(0)));
-                        
-                        // Show "Thinking..." placeholder while waiting for LLM
-                        data.innerHTML = '<span class="sxng-thinking">Thinking...</span>';
-                        if (wrapper) wrapper.style.display = '';
-                        box.style.display = 'block';
-                        
-                        const controller = new AbortController();
-                        const timeoutId = setTimeout(() => controller.abort(), 60000);
-                        
-                        const res = await fetch('/ai-stream', {{
-                            method: 'POST',
-                            headers: {{ 'Content-Type': 'application/json' }},
-                            body: JSON.stringify({{ q: q, context: ctx, tk: tk }}),
-                            signal: controller.signal
-                        }});
-                        
-                        clearTimeout(timeoutId);
-                        if (!res.ok) {{ if (wrapper) wrapper.remove(); else box.remove(); return; }}
-
-                        const reader = res.body.getReader();
-                        const decoder = new TextDecoder();
-                        const cursor = document.createElement('span');
-                        cursor.className = 'sxng-cursor';
-                        
-                        let started = false;
-                        while (true) {{
-                            const {{done, value}} = await reader.read();
-                            if (done) break;
-                            
-                            const chunk = decoder.decode(value);
-                            if (chunk) {{
-                                let text = chunk;
-                                if (!started) {{
-                                    text = text.replace(/^[\\s.,;:!?]+/, '');
-                                    if (!text) continue;
-                                    data.textContent = '';  // Clear "Thinking..."
-                                    data.appendChild(cursor);
-                                    started = true; 
-                                }}
-                                cursor.before(text);
-                            }}
-                        }}
-                        cursor.remove();
-                        data.textContent = data.textContent.trimEnd();
-                        if (!started) {{ if (wrapper) wrapper.remove(); else box.remove(); }}
-                    }} catch (e) {{ console.error(e); if (wrapper) wrapper.remove(); else box.remove(); }}
-                }})();
-                </script>
-            </article>
-            '''
+            tk = f"{stamp}.{self._sign(stamp, q_clean)}"
+
+            if self.context_stash:
+                self.context_stash.put(tk, context_str)
+
+            if self.precomputer:
+                self.precomputer.sketch.observe(q_clean, context_str)
+
+            key = _answer_key(self.provider, self.model, q_clean, context_str)
+            cached = bool(self.answer_cache and self.answer_cache.contains(key))
+            if self.semantic and not cached:
+                cached = self._reuse_similar(key, q_clean, raw_results)
+
+            if self.prefetcher and not cached:
+                self._prefetch(q_clean, context_str, key)
+
+            # Only the query and token vary per search; the widget's CSS/JS are cached static assets
+            html_payload = self.widget_template.format(
+                q=html.escape(q_clean),
+                tk=tk,
+                ctx="" if self.context_stash else f' data-ctx="{html.escape(context_str)}"')
             search.result_container.answers.add(results.types.Answer(answer=Markup(html_payload)))
         except Exception as e:
             logger.error(f"AI Answers plugin error: {e}")
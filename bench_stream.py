@@ -0,0 +1,406 @@
+import sys
+import os
+import json
+import time
+import argparse
+import resource
+import threading
+import statistics
+from types import ModuleType
+from concurrent.futures import ThreadPoolExecutor
+
+import mock_llm
+
+# Same searx stand-ins as test_standalone.py so the plugin imports outside SearXNG
+searx = ModuleType("searx")
+searx_plugins = ModuleType("searx.plugins")
+searx_results = ModuleType("searx.result_types")
+
+class MockPlugin:
+    def __init__(self, cfg):
+        self.active = True
+
+class MockEngineResults:
+    def __init__(self):
+        self.types = ModuleType("types")
+        self.types.Answer = lambda *args, **kwargs: kwargs.get('answer', args[0] if args else "")
+
+searx_plugins.Plugin = MockPlugin
+searx_plugins.PluginInfo = lambda **kwargs: kwargs
+searx_results.EngineResults = MockEngineResults
+sys.modules["searx"] = searx
+sys.modules["searx.plugins"] = searx_plugins
+sys.modules["searx.result_types"] = searx_results
+
+PROVIDER_ENV = {
+    "openrouter": {"LLM_PROVIDER": "openrouter", "OPENROUTER_BASE_URL": "{address}"},
+    "openai": {"LLM_PROVIDER": "openai", "OPENROUTER_BASE_URL": "{address}"},
+    "gemini": {"LLM_PROVIDER": "gemini", "GEMINI_BASE_URL": "{address}"},
+}
+
+
+def emit(args, record):
+    line = json.dumps(record)
+    print(line, flush=True)
+    if getattr(args, "out", None):
+        with open(args.out, "a") as f:
+            f.write(line + "\n")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))], 4)
+
+
+def legacy_sse(chunks):
+    # The original per-generator loop: per-chunk decode, str concat and split("\n", 1) per line
+    decoder = json.JSONDecoder()
+    buffer = ""
+    out = []
+    for chunk in chunks:
+        buffer += chunk.decode('utf-8')
+        while "\n" in buffer:
+            line, buffer = buffer.split("\n", 1)
+            if line.startswith("data: "):
+                data_str = line[6:].strip()
+                if data_str == "[DONE]":
+                    return out
+                try:
+                    obj, _ = decoder.raw_decode(data_str)
+                    content = obj.get("choices", [{}])[0].get("delta", {}).get("content", "")
+                    if content: out.append(content)
+                except json.JSONDecodeError:
+                    pass
+    return out
+
+
+def legacy_json_array(chunks):
+    # The original Gemini loop (plus array punctuation skipping): lstrip + raw_decode over the whole buffer
+    decoder = json.JSONDecoder()
+    buffer = ""
+    out = []
+    for chunk in chunks:
+        buffer += chunk.decode('utf-8')
+        while buffer:
+            buffer = buffer.lstrip(" \t\r\n[,]")
+            if not buffer: break
+            try:
+                obj, idx = decoder.raw_decode(buffer)
+                parts = obj.get('candidates', [{}])[0].get('content', {}).get('parts', [])
+                if parts and parts[0].get('text'): out.append(parts[0]['text'])
+                buffer = buffer[idx:]
+            except json.JSONDecodeError: break
+    return out
+
+
+def synthetic_stream(protocol, tokens):
+    # ASCII deltas so the legacy per-chunk decode does not trip over split characters
+    words = [f"word{i % 97} " for i in range(tokens)]
+    if protocol == "sse":
+        body = "".join(f"data: {json.dumps({'choices': [{'delta': {'content': w}}]})}\n\n" for w in words) + "data: [DONE]\n\n"
+    else:
+        body = "[" + ",\r\n".join(json.dumps({"candidates": [{"content": {"parts": [{"text": w}], "role": "model"}, "index": 0}]}) for w in words) + "]"
+    return body.encode('utf-8'), tokens
+
+
+def fragment(raw, size):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+def cpu_per_token(fn, chunks, tokens, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        out = fn(chunks)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert len(out) == tokens, (len(out), tokens)
+    return round(best / tokens * 1e6, 3)
+
+
+def bench_parsers(args):
+    from ai_answers import STREAM_PARSERS, READ_MIN, READ_MAX
+
+    def incremental(protocol):
+        def run(chunks):
+            parser = STREAM_PARSERS[protocol]()
+            out = []
+            for chunk in chunks:
+                out.extend(parser.feed(chunk))
+            return out
+        return run
+
+    legacy = {"sse": legacy_sse, "json-array": legacy_json_array}
+    for tokens in (int(n) for n in args.tokens.split(",")):
+        for protocol in ("sse", "json-array"):
+            raw, count = synthetic_stream(protocol, tokens)
+            runs = [
+                ("legacy", 128, legacy[protocol]),
+                ("incremental", 128, incremental(protocol)),
+                ("incremental", READ_MIN, incremental(protocol)),
+                ("incremental", READ_MAX, incremental(protocol)),
+            ]
+            for name, read_size, fn in runs:
+                emit(args, {
+                    "bench": "parser",
+                    "protocol": protocol,
+                    "impl": name,
+                    "tokens": count,
+                    "stream_bytes": len(raw),
+                    "read_size": read_size,
+                    "cpu_us_per_token": cpu_per_token(fn, fragment(raw, read_size), count, args.repeat),
+                })
+
+
+def serve(args):
+    # Child process for `load`: the plugin inside a threaded WSGI server, plus a /search page
+    # that runs post_search over synthetic results like test_standalone.py does
+    from flask import Flask, request
+    from werkzeug.serving import make_server
+    from ai_answers import SXNGPlugin
+
+    app = Flask(__name__)
+    plugin = SXNGPlugin(None)
+    plugin.init(app)
+    results = [
+        {"title": f"Result {i} about the topic", "content": " ".join(f"snippet{i} word{j}" for j in range(args.result_words))}
+        for i in range(args.results)
+    ]
+
+    @app.route("/search")
+    def search_page():
+        class SearchQuery:
+            pageno = 1
+            query = request.args.get("q", "why is the sky blue")
+
+        class ResultContainer:
+            def __init__(self):
+                self.answers = set()
+
+            def get_ordered_results(self):
+                return results
+
+        class Search:
+            search_query = SearchQuery()
+            result_container = ResultContainer()
+
+        search = Search()
+        plugin.post_search(None, search)
+        return "".join(search.result_container.answers)
+
+    @app.route("/bench-cpu")
+    def cpu_time():
+        # Lets the driver leave interpreter start-up and imports out of the measured CPU time
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {"cpu_s": usage.ru_utime + usage.ru_stime}
+
+    server = make_server("127.0.0.1", args.port, app, threaded=True)
+    if args.threads:
+        # A fixed set of request threads, like a gthread worker, instead of one thread per connection
+        pool = ThreadPoolExecutor(max_workers=args.threads)
+        server.process_request = lambda request, address: pool.submit(server.process_request_thread, request, address)
+    server.serve_forever()
+
+
+def _drive(target, port, concurrency, duration, query_pool):
+    # Closed-loop load: `concurrency` client threads issue requests back to back for `duration`
+    import re
+    import http.client
+    token_re = re.compile(r'data-tk="(.*?)"')
+    latencies, ttfts, reads, errors = [], [], [], [0]
+    stop_at = time.perf_counter() + duration
+    lock = threading.Lock()
+
+    def request(method, path, body=None):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        headers = {"Content-Type": "application/json"} if body else {}
+        conn.request(method, path, body=body, headers=headers)
+        return conn, conn.getresponse()
+
+    def client(worker):
+        i = 0
+        while time.perf_counter() < stop_at:
+            i += 1
+            q = f"bench query {i % query_pool}" if query_pool else f"bench query {worker} {i}"
+            path = "/search?q=" + q.replace(" ", "+")
+            try:
+                started = time.perf_counter()
+                conn, res = request("GET", path)
+                page = res.read().decode("utf-8")
+                conn.close()
+                if target == "post_search":
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+                    continue
+                token = token_re.search(page).group(1)
+                started = time.perf_counter()
+                conn, res = request("POST", "/ai-stream", json.dumps({"q": q, "tk": token}))
+                ttft = None
+                count = 0
+                # Like reader.read() in the widget: one call per frame that has arrived
+                while res.status == 200:
+                    data = res.read1(65536)
+                    if not data:
+                        break
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                    count += 1
+                conn.close()
+                if ttft is None:
+                    with lock:
+                        errors[0] += 1
+                    continue
+                with lock:
+                    ttfts.append(ttft)
+                    reads.append(count)
+                    latencies.append(time.perf_counter() - started)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(w,)) for w in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, ttfts, reads, errors[0], time.perf_counter() - started
+
+
+def _start_server(args, upstream, provider, env=None, threads=0):
+    # Starts a `serve` child on a free port once it answers; returns it with a server CPU time probe
+    import socket
+    import tempfile
+    import subprocess
+    import http.client
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    child_env = dict(os.environ, OPENROUTER_API_KEY="bench",
+                     ANSWER_CACHE_PATH=os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+    child_env.update({k: v.format(address=upstream.address) for k, v in PROVIDER_ENV[provider].items()})
+    child_env.update(env or {})
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", "--port", str(port), "--threads", str(threads),
+                               "--results", str(args.results), "--result-words", str(args.result_words)],
+                              env=child_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def server_cpu():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request("GET", "/bench-cpu")
+        return json.loads(conn.getresponse().read())["cpu_s"]
+
+    for _ in range(200):
+        try:
+            server_cpu()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return server, port, server_cpu
+
+
+def _stop_server(server):
+    # Returns the server's peak RSS in MB
+    import signal
+    server.send_signal(signal.SIGTERM)
+    # wait4 rather than Popen.wait: the rusage carries the server's peak RSS
+    _, status, usage = os.wait4(server.pid, 0)
+    server.returncode = status
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def bench_load(args):
+    upstream = mock_llm.from_arguments(args).start()
+    for target in args.targets.split(","):
+        for concurrency in (int(n) for n in args.concurrency.split(",")):
+            server, port, server_cpu = _start_server(args, upstream, args.provider, threads=args.threads)
+            cpu_before = server_cpu()
+            tokens_before = upstream.stats["tokens_sent"]
+            latencies, ttfts, reads, errors, wall = _drive(target, port, concurrency, args.duration, args.query_pool)
+            tokens = upstream.stats["tokens_sent"] - tokens_before
+            cpu = server_cpu() - cpu_before
+            rss_mb = _stop_server(server)
+            emit(args, {
+                "bench": "load",
+                "target": target,
+                "provider": args.provider,
+                "concurrency": concurrency,
+                "duration_s": round(wall, 3),
+                "requests": len(latencies),
+                "errors": errors,
+                "rps": round(len(latencies) / wall, 2),
+                "latency_p50_s": percentile(latencies, 50),
+                "latency_p95_s": percentile(latencies, 95),
+                "ttft_p50_s": percentile(ttfts, 50),
+                "ttft_p90_s": percentile(ttfts, 90),
+                "ttft_p99_s": percentile(ttfts, 99),
+                "client_reads_per_answer": round(statistics.mean(reads), 1) if reads else None,
+                "upstream_tokens": tokens,
+                "server_cpu_s": round(cpu, 3),
+                "cpu_us_per_token": round(cpu / tokens * 1e6, 2) if tokens else None,
+                "cpu_ms_per_request": round(cpu / len(latencies) * 1e3, 3) if latencies else None,
+                "peak_rss_mb": round(rss_mb, 1),
+            })
+
+
+def compare(args):
+    # Relative change of every numeric field between two result files, matched on the descriptive fields
+    def load(path):
+        records = {}
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    key = tuple(sorted((k, v) for k, v in record.items() if isinstance(v, str) or k in ("concurrency", "streams", "threads", "tokens", "read_size")))
+                    records[key] = record
+        return records
+
+    base, new = load(args.baseline), load(args.candidate)
+    for key in base.keys() & new.keys():
+        deltas = {}
+        for field, old in base[key].items():
+            value = new[key].get(field)
+            if isinstance(old, (int, float)) and isinstance(value, (int, float)) and dict(key).get(field) is None:
+                deltas[field] = {"baseline": old, "candidate": value, "change_pct": round((value - old) / old * 100, 1) if old else None}
+        print(json.dumps(dict(dict(key), deltas=deltas)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI Answers benchmarks; one JSON object per line")
+    parser.add_argument("--out", help="also append results to this JSONL file")
+    sub = parser.add_subparsers(dest="bench")
+    parse = sub.add_parser("parser", help="CPU per token of the stream parsers on long synthetic streams")
+    parse.add_argument("--tokens", default="1000,10000,50000", help="comma separated stream lengths")
+    parse.add_argument("--repeat", type=int, default=3)
+    load = sub.add_parser("load", help="end-to-end load on /ai-stream and post_search against the mock LLM")
+    load.add_argument("--targets", default="post_search,ai-stream", help="comma separated: post_search, ai-stream")
+    load.add_argument("--provider", default="openrouter", choices=sorted(PROVIDER_ENV))
+    load.add_argument("--concurrency", default="1,8,32", help="comma separated client counts")
+    load.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    load.add_argument("--threads", type=int, default=0, help="request threads of the plugin server (0: one per connection)")
+    load.add_argument("--query-pool", type=int, default=0, help="reuse N distinct queries (0: every query unique)")
+    load.add_argument("--results", type=int, default=10, help="synthetic search results per page")
+    load.add_argument("--result-words", type=int, default=60)
+    mock_llm.add_arguments(load)
+    srv = sub.add_parser("serve", help=argparse.SUPPRESS)
+    srv.add_argument("--port", type=int, required=True)
+    srv.add_argument("--threads", type=int, default=0)
+    srv.add_argument("--results", type=int, default=10)
+    srv.add_argument("--result-words", type=int, default=60)
+    cmp = sub.add_parser("compare", help="relative change between two result files")
+    cmp.add_argument("baseline")
+    cmp.add_argument("candidate")
+    args = parser.parse_args()
+
+    commands = {"parser": bench_parsers, "load": bench_load, "serve": serve, "compare": compare}
+    if args.bench in commands:
+        commands[args.bench](args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import sys
+import json
+import random
+import asyncio
+import argparse
+import threading
+
+# Local stand-in for the upstream LLM APIs the plugin talks to:
+#   POST /api/v1/chat/completions, /v1/chat/completions   OpenRouter / Ollama (OpenAI SSE)
+#   POST /api/chat/completions                            Open WebUI (OpenAI SSE)
+#   POST /v1/models/<model>:streamGenerateContent         Gemini (streamed JSON array)
+# Point the plugin at it with OPENROUTER_BASE_URL / GEMINI_BASE_URL=127.0.0.1:<port>.
+# Token usage is reported like the real APIs, with the bytes shared with the previous request
+# body counted as cached prompt tokens (about 4 bytes per token).
+
+
+class MockLLMServer:
+    def __init__(self, host="127.0.0.1", port=0, ttft=0.3, token_rate=40.0, tokens=40,
+                 fragment=0, error_rate=0.0, error_status=429, disconnect_rate=0.0, seed=None, ssl=None):
+        self.ttft = ttft
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.fragment = fragment
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self._last_body = b""
+        self.stats = {"requests": 0, "tokens_sent": 0, "errors": 0, "disconnects": 0, "active": 0, "peak_active": 0, "connections": 0}
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(self._handle, host, port, backlog=4096, ssl=ssl))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.address = f"{host}:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self.loop.run_forever, name="mock-llm", daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self.loop.run_forever()
+
+    async def _handle(self, reader, writer):
+        self.stats["connections"] += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                path = request_line.split(" ")[1]
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                keep_alive = await self._respond(writer, path, body)
+                if not keep_alive or headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _usage(self, body):
+        shared = 0
+        for a, b in zip(body, self._last_body):
+            if a != b:
+                break
+            shared += 1
+        self._last_body = body
+        return len(body) // 4, shared // 4
+
+    async def _respond(self, writer, path, body=b""):
+        self.stats["requests"] += 1
+        if "streamGenerateContent" in path:
+            protocol = "gemini"
+        elif path.endswith("/chat/completions"):
+            protocol = "sse"
+        else:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+            return True
+
+        prompt_tokens, cached_tokens = self._usage(body)
+        await asyncio.sleep(self.ttft)
+        if self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            body = json.dumps({"error": {"code": self.error_status, "message": "mock upstream error"}}).encode()
+            writer.write(b"HTTP/1.1 %d Error\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (self.error_status, len(body), body))
+            await writer.drain()
+            return True
+
+        content_type = b"application/json" if protocol == "gemini" else b"text/event-stream"
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: %s\r\nTransfer-Encoding: chunked\r\n\r\n" % content_type)
+        cut_at = self.random.randrange(1, self.tokens) if self.tokens > 1 and self.random.random() < self.disconnect_rate else None
+        self.stats["active"] += 1
+        self.stats["peak_active"] = max(self.stats["peak_active"], self.stats["active"])
+        try:
+            if protocol == "gemini":
+                await self._send(writer, b"[")
+            for i in range(self.tokens):
+                if i == cut_at:
+                    # Mid-stream disconnect: drop the socket without the terminating chunk
+                    self.stats["disconnects"] += 1
+                    writer.transport.abort()
+                    return False
+                text = f"tok{i} "
+                if protocol == "gemini":
+                    event = json.dumps({"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}]})
+                    await self._send(writer, (event if i == 0 else ",\r\n" + event).encode())
+                else:
+                    event = json.dumps({"choices": [{"index": 0, "delta": {"content": text}}]})
+                    await self._send(writer, f"data: {event}\n\n".encode())
+                self.stats["tokens_sent"] += 1
+                if self.token_rate > 0:
+                    await asyncio.sleep(1 / self.token_rate)
+            if protocol == "gemini":
+                usage = {"promptTokenCount": prompt_tokens, "cachedContentTokenCount": cached_tokens, "candidatesTokenCount": self.tokens}
+                await self._send(writer, (("," if self.tokens else "") + "\r\n" + json.dumps({"usageMetadata": usage}) + "]").encode())
+            else:
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": self.tokens, "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+                await self._send(writer, f"data: {json.dumps({'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n".encode())
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return True
+        finally:
+            self.stats["active"] -= 1
+
+    async def _send(self, writer, data):
+        # Optional fragmentation: split each event into random pieces, each its own HTTP chunk
+        pieces = [data]
+        if self.fragment > 0 and len(data) > 1:
+            pieces, rest = [], data
+            while rest:
+                size = self.random.randint(1, self.fragment)
+                pieces.append(rest[:size])
+                rest = rest[size:]
+        for piece in pieces:
+            writer.write(b"%x\r\n%s\r\n" % (len(piece), piece))
+            await writer.drain()
+
+
+def add_arguments(parser):
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=40.0, help="tokens per second, 0 for as fast as possible")
+    parser.add_argument("--tokens", type=int, default=40, help="tokens per answer")
+    parser.add_argument("--fragment", type=int, default=0, help="split events into random pieces of at most N bytes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="fraction of streams cut mid-answer")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def from_arguments(args, port=0):
+    return MockLLMServer(port=port, ttft=args.ttft, token_rate=args.token_rate, tokens=args.tokens,
+                         fragment=args.fragment, error_rate=args.error_rate, error_status=args.error_status,
+                         disconnect_rate=args.disconnect_rate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI/OpenRouter, Open WebUI and Gemini streaming server")
+    parser.add_argument("--port", type=int, default=8089)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = from_arguments(args, args.port)
+    print(f"Mock LLM listening on {server.address}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 import sys
 import os
+import time
+import threading
+import queue
 import logging
 from types import ModuleType
 from flask import Flask, request
@@ -37,6 +40,7 @@ sys.modules["searx"] = searx
 sys.modules["searx.plugins"] = searx_plugins
 sys.modules["searx.result_types"] = searx_results
 
+import ai_answers
 from ai_answers import SXNGPlugin
 from flask_babel import Babel
 
@@ -111,16 +115,68 @@ class PluginTestCase(unittest.TestCase):
         response = self.app.get('/')
         content = response.data.decode('utf-8')
         self.assertIn('<article id="sxng-stream-box"', content)
-        self.assertIn('/ai-stream', content)
+        self.assertIn(f'/ai-static/{ai_answers.WIDGET_VERSION}/widget.js', content)
+        self.assertNotIn('@keyframes', content)
+
+        # The widget code itself is a versioned, immutable asset
+        asset = self.app.get(f'/ai-static/{ai_answers.WIDGET_VERSION}/widget.js')
+        self.assertIn('/ai-stream', asset.data.decode('utf-8'))
+        self.assertIn('immutable', asset.headers['Cache-Control'])
+        again = self.app.get(f'/ai-static/{ai_answers.WIDGET_VERSION}/widget.js', headers={'If-None-Match': asset.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(self.app.get(f'/ai-static/{ai_answers.WIDGET_VERSION}/other.js').status_code, 404)
+
+        # The query lands in an attribute, escaped
+        import re
+        content = self.app.get('/?q=%22%3E%3Cscript%3Ealert(1)%3C/script%3E').data.decode('utf-8')
+        article = re.search(r'<article id="sxng-stream-box".*?</article>', content, re.S).group(0)
+        self.assertNotIn('<script>alert', article)
+        self.assertIn('data-q="&quot;&gt;&lt;script&gt;alert(1)&lt;/script&gt;"', article)
+
+    def test_context_stays_on_server(self):
+        if not plugin.context_stash:
+            self.skipTest("Context stash disabled")
+        content = self.app.get('/').data.decode('utf-8')
+        import re
+        token = re.search(r'data-tk="(.*?)"', content).group(1)
+        self.assertNotIn("Rayleigh scattering", content)
+        self.assertIn("Rayleigh scattering", plugin.context_stash.get(token))
+
+        # Every search of the same query, even within one second, gets its own token and stash entry
+        second = re.search(r'data-tk="(.*?)"', self.app.get('/').data.decode('utf-8')).group(1)
+        self.assertNotEqual(second, token)
+
+        # A validly signed token with nothing stashed behind it is rejected rather than answered without context.
+        # The query is never searched, so no earlier run can have stashed a context under the same token.
+        import hashlib
+        stamp = f"{int(time.time()) - 30}.0123456789abcdef"
+        unknown = f"{stamp}.{plugin._sign(stamp, 'never searched')}"
+        response = self.app.post('/ai-stream', json={"q": "never searched", "context": "forged", "tk": unknown})
+        self.assertEqual(response.status_code, 410)
+
+        # Hex characters cannot be moved between the nonce and the query
+        stamp = f"{int(time.time())}.0123456789abcd"
+        signed = f"{stamp}.{plugin._sign(stamp, 'beef stew')}"
+        self.assertTrue(plugin._verify_token(signed, "beef stew", 60))
+        shifted = f"{stamp}be.{signed.rsplit('.', 1)[1]}"
+        self.assertFalse(plugin._verify_token(shifted, "ef stew", 60))
+        # Tokens of pages rendered before the nonce still verify until they expire
+        legacy = f"{int(time.time())}"
+        legacy = f"{legacy}.{hashlib.sha256(f'{legacy}beef stew{plugin.secret}'.encode()).hexdigest()}"
+        self.assertTrue(plugin._verify_token(legacy, "beef stew", 60))
+
+        # The client cannot send a context anyway, so a large body is refused before it is parsed
+        response = self.app.post('/ai-stream', json={"q": "never searched", "context": "x" * 10000, "tk": unknown})
+        self.assertEqual(response.status_code, 413)
 
     def test_stream_endpoint(self):
         # Trigger index to generate a response containing the token
         response = self.app.get('/')
         content = response.data.decode('utf-8')
         
-        # Extract the token from the injected script (tk = "...")
+        # Extract the token from the injected placeholder (data-tk="...")
         import re
-        match = re.search(r'const tk = "(.*?)";', content)
+        match = re.search(r'data-tk="(.*?)"', content)
         if not match:
             self.fail("Handshake token not found in injection")
         token = match.group(1)
@@ -144,5 +200,641 @@ class PluginTestCase(unittest.TestCase):
         data = response.data.decode('utf-8')
         print(f"\n[Test] Received {len(data)} bytes from {plugin.provider}")
 
+    def test_answer_cache_hit(self):
+        if not plugin.answer_cache:
+            self.skipTest("Answer cache disabled")
+        response = self.app.get('/')
+        import re
+        token = re.search(r'data-tk="(.*?)"', response.data.decode('utf-8')).group(1)
+
+        context = plugin.context_stash.get(token) if plugin.context_stash else "The sky is blue because of Rayleigh scattering."
+        key = ai_answers._answer_key(plugin.provider, plugin.model, "Why is  the sky blue", context)
+        plugin.answer_cache.put(key, "Rayleigh scattering.")
+        before = plugin.answer_cache.stats().get("hits", 0)
+
+        response = self.app.post('/ai-stream', json={"q": "why is the sky blue", "context": context, "tk": token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode('utf-8'), "Rayleigh scattering.")
+        self.assertEqual(plugin.answer_cache.stats()["hits"], before + 1)
+
+    def test_shared_store_evicts_least_recently_used(self):
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), "store.sqlite3")
+        store = ai_answers.SharedStore(path, 'answers', 60, 100, 3)
+        for key in ("a", "b", "c"):
+            store.put(key, "x" * 20)
+            time.sleep(0.01)
+        store.get("a")
+        store.put("d", "x" * 20)
+        # Over the entry cap: the least recently used entry goes
+        self.assertEqual([store.contains(k) for k in "abcd"], [True, False, True, True])
+        # Replacing a value updates the byte total; over the byte cap, the oldest entries go
+        store.put("d", "x" * 70)
+        self.assertEqual([store.contains(k) for k in "acd"], [True, False, True])
+        self.assertEqual((store.stats()["entries"], store.stats()["bytes"]), (2, 90))
+        # peek reads without counting a hit or miss
+        before = store.stats()
+        self.assertEqual((store.peek("d"), store.peek("b")), ("x" * 70, None))
+        self.assertEqual(store.stats(), before)
+        # A second store on the same file sees the same totals
+        self.assertEqual(ai_answers.SharedStore(path, 'answers', 60, 100, 3).stats()["bytes"], 90)
+
+    def test_coalescing_flushes_first_delta_then_batches(self):
+        def upstream():
+            yield from ["Ray", "le", "igh", " sc", "at", "ter", "ing."]
+            return True
+
+        saved = plugin.flush_sec, plugin.flush_chars
+        plugin.flush_sec, plugin.flush_chars = 60, 5
+        try:
+            frames = plugin._coalescing(upstream())
+            self.assertEqual(next(frames), "Ray")
+            rest = []
+            while True:
+                try:
+                    rest.append(next(frames))
+                except StopIteration as stop:
+                    self.assertTrue(stop.value)
+                    break
+        finally:
+            plugin.flush_sec, plugin.flush_chars = saved
+        self.assertEqual(rest, ["leigh", " scat", "tering."])
+
+    def test_coalescing_flushes_pending_text_when_upstream_pauses(self):
+        chunks = queue.SimpleQueue()
+        saved = plugin.flush_sec, plugin.flush_chars
+        plugin.flush_sec, plugin.flush_chars = 0.05, 512
+        try:
+            frames = plugin._coalescing(ai_answers._from_queue(chunks, plugin.flush_sec))
+            chunks.put("Ray")
+            self.assertEqual(next(frames), "Ray")
+            chunks.put("le")
+            # Nothing follows "le": the idle tick flushes it once the window has passed
+            started = time.monotonic()
+            self.assertEqual(next(frames), "le")
+            self.assertLess(time.monotonic() - started, 1)
+            chunks.put("igh")
+            chunks.put(ai_answers._StreamEnd(True))
+            with self.assertRaises(StopIteration) as stop:
+                while True:
+                    self.assertEqual(next(frames), "igh")
+            self.assertTrue(stop.exception.value)
+        finally:
+            plugin.flush_sec, plugin.flush_chars = saved
+
+    def test_blocking_stream_flushes_pending_text_when_upstream_pauses(self):
+        import json
+        import socket
+        listener = socket.create_server(("127.0.0.1", 0))
+
+        def event(text):
+            return f"data: {json.dumps({'choices': [{'delta': {'content': text}}]})}\n\n".encode()
+
+        def chunk(data):
+            return b"%x\r\n%s\r\n" % (len(data), data)
+
+        def serve():
+            conn, _ = listener.accept()
+            with conn:
+                conn.recv(65536)
+                conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n"
+                             + chunk(event("Ray") + event("le")))
+                time.sleep(0.5)
+                conn.sendall(chunk(event("igh") + b"data: [DONE]\n\n") + b"0\r\n\r\n")
+                conn.recv(1)
+
+        threading.Thread(target=serve, daemon=True).start()
+        address = f"127.0.0.1:{listener.getsockname()[1]}"
+        req = ai_answers.Backend("openrouter", "m", "key", address, 100, 0.2).request("q")
+        saved = plugin.flush_sec, plugin.flush_chars
+        plugin.flush_sec, plugin.flush_chars = 0.05, 512
+        try:
+            started = time.monotonic()
+            frames = [(text, time.monotonic() - started) for text in plugin._coalescing(plugin._generate(req, idle_sec=0.05))]
+        finally:
+            plugin.flush_sec, plugin.flush_chars = saved
+            listener.close()
+        # "le" arrived with "Ray" but inside the window; it goes out when the window expires, not with "igh"
+        self.assertEqual([text for text, _ in frames], ["Ray", "le", "igh"])
+        self.assertLess(frames[1][1], 0.3)
+
+    def test_single_flight_shares_upstream(self):
+        started, closed = [], []
+
+        def upstream():
+            started.append(1)
+            try:
+                yield "a"
+                yield "b"
+                yield "c"
+            finally:
+                closed.append(1)
+
+        flights = ai_answers.SingleFlight()
+        first = flights.stream("k", upstream)
+        self.assertEqual(next(first), "a")
+        second = flights.stream("k", upstream)
+        self.assertEqual(next(second), "a")
+        self.assertEqual(next(first), "b")
+        first.close()
+        self.assertEqual(list(second), ["b", "c"])
+        self.assertEqual(len(started), 1)
+        self.assertEqual(flights.stats(), {"in_flight": 0, "coalesced": 1})
+
+        abandoned = flights.stream("k", upstream)
+        next(abandoned)
+        abandoned.close()
+        self.assertEqual(len(closed), 2)
+
+    def test_stream_parsers_fragmented_utf8(self):
+        import json
+        words = ["Rayleigh ", "scattering ", "— ", "blåbær ", "🌍", "\"quoted\" {braces}"]
+        sse = "".join(f"data: {json.dumps({'choices': [{'delta': {'content': w}}]})}\n\n" for w in words) + "data: [DONE]\n\n"
+        gemini = "[" + ",\r\n".join(json.dumps({"candidates": [{"content": {"parts": [{"text": w}]}}]}, ensure_ascii=False) for w in words) + "]"
+
+        for protocol, body in (("sse", sse), ("json-array", gemini)):
+            for step in (1, 3, 7, 4096):
+                parser = ai_answers.STREAM_PARSERS[protocol]()
+                raw = body.encode('utf-8')
+                out = []
+                for i in range(0, len(raw), step):
+                    out.extend(parser.feed(raw[i:i + step]))
+                self.assertEqual(out, words, f"{protocol} step={step}")
+                self.assertTrue(parser.done)
+
+    def test_async_engine_streams_from_mock_upstream(self):
+        import mock_llm
+
+        def collect(stream):
+            out = []
+            while True:
+                try:
+                    out.append(next(stream))
+                except StopIteration as stop:
+                    return "".join(out), stop.value
+
+        # Chunked bodies split into 1-3 byte HTTP chunks, for both stream protocols
+        upstream = mock_llm.MockLLMServer(ttft=0, token_rate=0, tokens=30, fragment=3, seed=1).start()
+        engine = ai_answers.AsyncStreamEngine(4)
+        expected = "".join(f"tok{i} " for i in range(30))
+        for provider in ("openrouter", "openai", "gemini"):
+            req = ai_answers.Backend(provider, "m", "key", upstream.address, 100, 0.2).request("q")
+            self.assertEqual(collect(engine.stream(req)), (expected, True), provider)
+        # Each finished response leaves its connection open for the next one
+        self.assertEqual(upstream.stats["connections"], 1)
+        self.assertEqual(engine.pool_stats(), {f"http://{upstream.address}": 1})
+
+        # Error responses carry a Content-Length body; the stream ends without text or success
+        failing = mock_llm.MockLLMServer(ttft=0, error_rate=1.0).start()
+        req = ai_answers.Backend("openrouter", "m", "key", failing.address, 100, 0.2).request("q")
+        self.assertEqual(collect(engine.stream(req)), ("", None))
+        self.assertEqual(collect(engine.stream(req)), ("", None))
+        self.assertEqual((failing.stats["errors"], failing.stats["connections"]), (2, 1))
+
+    def test_prompt_prefix_is_stable_and_usage_reported(self):
+        import json
+        for provider in ("openrouter", "openai", "gemini"):
+            backend = ai_answers.Backend(provider, "m", "key", "example.org", 100, 0.2)
+            first, second = backend.request("USER QUERY: a").body, backend.request("USER QUERY: something else").body
+            shared = len(os.path.commonprefix([first, second]))
+            # The instructions sit entirely in the byte-identical leading part of the body
+            self.assertIn(json.dumps(ai_answers.SYSTEM_PROMPT), first[:shared])
+            payload = json.loads(first)
+            if provider == "gemini":
+                self.assertEqual(payload["contents"][0]["parts"][1]["text"], "USER QUERY: a")
+            else:
+                self.assertEqual(payload["messages"], [backend.system_message, {"role": "user", "content": "USER QUERY: a"}])
+                self.assertTrue(payload["stream_options"]["include_usage"])
+
+        marked = ai_answers.Backend("openrouter", "m", "key", "openrouter.ai", 100, 0.2, cache_control=True)
+        system = json.loads(marked.request("q").body)["messages"][0]
+        self.assertEqual(system["content"][0]["cache_control"], {"type": "ephemeral"})
+
+        usage = {"prompt_tokens": 900, "prompt_tokens_details": {"cached_tokens": 640}}
+        sse = f"data: {json.dumps({'choices': [{'delta': {'content': 'hi'}}]})}\n\ndata: {json.dumps({'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n"
+        gemini = json.dumps([{"candidates": [{"content": {"parts": [{"text": "hi"}]}}], "usageMetadata": {"promptTokenCount": 900, "cachedContentTokenCount": 512}}])
+        for protocol, body, cached in (("sse", sse, 640), ("json-array", gemini, 512)):
+            parser = ai_answers.STREAM_PARSERS[protocol]()
+            self.assertEqual(parser.feed(body.encode()), ["hi"])
+            self.assertEqual(ai_answers._prompt_usage(parser.usage), (900, cached))
+
+    def test_context_builder_budget_and_dedup(self):
+        builder = ai_answers.ContextBuilder(budget=120, result_tokens=60, max_results=6, dup_threshold=0.8)
+        results = [
+            {"title": "Fact <b>About</b> Sky", "content": "The sky is blue because of Rayleigh &amp; scattering."},
+            {"title": "Fact About Sky", "content": "The sky is blue because of  Rayleigh & scattering!"},
+            {"title": "", "content": "   "},
+            {"title": "Long", "content": "word " * 500},
+            {"title": "Atmosphere", "content": "Shorter wavelengths scatter more."},
+        ]
+        context = builder.build(results)
+        lines = context.split("\n")
+        self.assertEqual(lines[0], "[1] Fact About Sky: The sky is blue because of Rayleigh & scattering.")
+        self.assertTrue(lines[1].startswith("[2] Long: word word") and lines[1].endswith("…"))
+        self.assertTrue(lines[2].startswith("[3] Atmosphere"))
+        self.assertLessEqual(ai_answers._estimate_tokens(context), 120 + len(lines))
+        stats = builder.stats()
+        self.assertEqual((stats["duplicates"], stats["empty"], stats["truncated"]), (1, 1, 1))
+
+    @unittest.skipIf(ai_answers.np is None, "numpy not installed")
+    def test_semantic_index_needs_similar_query_and_results(self):
+        index = ai_answers.SemanticIndex(capacity=4, query_threshold=0.9, url_threshold=0.6)
+        results = [{"url": f"https://example.org/{i}"} for i in range(6)]
+        index.add("sky", index.embed("why is the sky blue"), index.url_hashes(results))
+        for i in range(2):
+            index.add(f"other{i}", index.embed(f"unrelated search {i}"), index.url_hashes([{"url": f"https://other.org/{i}"}]))
+
+        overlapping = results[:5] + [{"url": "https://example.org/new"}]
+        self.assertEqual(index.lookup(index.embed("Why the sky is blue?"), index.url_hashes(overlapping)), ["sky"])
+        self.assertEqual(index.lookup(index.embed("blue paint colors"), index.url_hashes(overlapping)), [])
+
+        # One changed word or version number, same results: a different question all the same
+        for stored, asked in [("is coffee good for you", "is coffee bad for you"),
+                              ("python 3.11 release date", "python 3.12 release date")]:
+            probe = ai_answers.SemanticIndex(capacity=4, query_threshold=0.9, url_threshold=0.6)
+            probe.add(stored, probe.embed(stored), probe.url_hashes(results), probe.numbers_in(stored))
+            self.assertEqual(probe.lookup(probe.embed(asked), probe.url_hashes(results), probe.numbers_in(asked)), [], asked)
+        # Numbers must match even where the trigrams alone would pass
+        probe = ai_answers.SemanticIndex(capacity=4, query_threshold=0.8, url_threshold=0.6)
+        probe.add("311", probe.embed("python 3.11 release date"), probe.url_hashes(results), probe.numbers_in("python 3.11 release date"))
+        self.assertEqual(probe.lookup(probe.embed("python 3.12 release date"), probe.url_hashes(results), probe.numbers_in("python 3.12 release date")), [])
+        self.assertEqual(probe.lookup(probe.embed("Python 3.11 release date?"), probe.url_hashes(results), probe.numbers_in("Python 3.11 release date?")), ["311"])
+        elsewhere = results[:2] + [{"url": f"https://example.net/{i}"} for i in range(4)]
+        self.assertEqual(index.lookup(index.embed("why is the sky blue"), index.url_hashes(elsewhere)), [])
+
+        # Oldest entries are overwritten once full
+        index.add("a", index.embed("a"), index.url_hashes([{"url": "https://a"}]))
+        index.add("b", index.embed("b"), index.url_hashes([{"url": "https://b"}]))
+        self.assertEqual(index.lookup(index.embed("why is the sky blue"), index.url_hashes(results)), [])
+        self.assertEqual(index.stats()["entries"], 4)
+
+    def test_prefetch_claim_and_expiry(self):
+        closed = []
+
+        def upstream(n, delay):
+            def gen():
+                try:
+                    for i in range(n):
+                        time.sleep(delay)
+                        yield str(i)
+                    return True
+                finally:
+                    closed.append(1)
+            return gen
+
+        flights = ai_answers.SingleFlight()
+        prefetcher = ai_answers.Prefetcher(flights, max_concurrent=2, claim_sec=0.3, max_chunks=100)
+
+        # Finished before the browser asked: served from the claim buffer
+        self.assertTrue(prefetcher.start("done", upstream(3, 0)))
+        for _ in range(50):
+            if prefetcher.stats()["finished"]: break
+            time.sleep(0.01)
+        self.assertEqual(prefetcher.claim("done"), "012")
+
+        # Claimed mid-stream: the request attaches to the running generation
+        self.assertTrue(prefetcher.start("live", upstream(5, 0.02)))
+        time.sleep(0.05)
+        self.assertEqual("".join(flights.stream("live", upstream(5, 0.02))), "01234")
+
+        # Never claimed: the generation is cancelled after the deadline
+        self.assertTrue(prefetcher.start("orphan", upstream(1000, 0.01)))
+        self.assertFalse(prefetcher.start("orphan", upstream(1000, 0.01)))
+        time.sleep(0.5)
+        stats = prefetcher.stats()
+        self.assertEqual((stats["claimed"], stats["expired"], stats["active"]), (1, 1, 0))
+        self.assertEqual(len(closed), 3)
+
+        # Still waiting for a first token at the deadline: the abort stops the upstream, the thread does not wait for it
+        upstream_abort = ai_answers._Abort()
+        first_token = threading.Event()
+        upstream_abort.set(first_token.set)
+
+        def silent():
+            first_token.wait(5)
+            return None
+            yield
+
+        started = time.monotonic()
+        self.assertTrue(prefetcher.start("silent", silent, abort=upstream_abort))
+        while prefetcher.stats()["active"] and time.monotonic() - started < 3:
+            time.sleep(0.01)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(prefetcher.stats()["expired"], 2)
+
+    def test_router_failover_and_hedging(self):
+        import asyncio
+
+        class FakeEngine(ai_answers.AsyncStreamEngine):
+            # Behaviour keyed on the backend host instead of real sockets
+            async def _fetch(self, req, emit):
+                if req.host == "down":
+                    return None
+                await asyncio.sleep(2.0 if req.host == "slow" else 0.05)
+                emit(f"from {req.host}")
+                return True
+
+        def backend(host):
+            return ai_answers.Backend("openrouter", host, "key", host, 100, 0.2, name=host)
+
+        engine = FakeEngine(16)
+        router = ai_answers.Router([backend("down"), backend("slow"), backend("fast")], engine,
+                                   hedge_after=0.2, failure_threshold=1, open_sec=30)
+        started = time.monotonic()
+        self.assertEqual("".join(router.stream("hi")), "from fast")
+        self.assertLess(time.monotonic() - started, 1.0)
+
+        stats = router.stats()
+        self.assertEqual(stats["hedged"], 1)
+        self.assertEqual(stats["backends"]["down"]["circuit"], "open")
+        # The hedged-out backend only contributes a latency sample
+        self.assertEqual(stats["backends"]["slow"]["requests"], 0)
+        self.assertIsNotNone(stats["backends"]["slow"]["ttft_ewma_s"])
+        self.assertEqual(router.order()[0].name, "fast")
+        self.assertEqual("".join(router.stream("hi")), "from fast")
+
+    def test_metrics_aggregate_across_workers(self):
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), "metrics.sqlite3")
+        # Two instances on one file stand in for two worker processes
+        workers = [ai_answers.Metrics(path), ai_answers.Metrics(path)]
+        labels = {"provider": "gemini", "model": "m"}
+        for metrics, ttft in zip(workers, (0.2, 3.0)):
+            metrics.observe("ai_answers_ttft_seconds", ttft, labels)
+            metrics.inc("ai_answers_upstream_responses_total", dict(labels, status=429))
+            metrics.flush()
+
+        text = workers[0].render()
+        self.assertIn("# TYPE ai_answers_ttft_seconds histogram", text)
+        self.assertIn('ai_answers_ttft_seconds_bucket{model="m",provider="gemini",le="0.25"} 1', text)
+        self.assertIn('ai_answers_ttft_seconds_bucket{model="m",provider="gemini",le="+Inf"} 2', text)
+        self.assertIn('ai_answers_ttft_seconds_count{model="m",provider="gemini"} 2', text)
+        self.assertIn('ai_answers_upstream_responses_total{model="m",provider="gemini",status="429"} 2', text)
+
+        # Gauges count live processes only: a worker that died mid-stream leaves nothing behind
+        import subprocess
+        gone = subprocess.Popen([sys.executable, "-c", "pass"])
+        gone.wait()
+        workers[0]._db().execute("INSERT INTO gauges VALUES (?, 'ai_answers_streams_in_flight', '', 5)", (gone.pid,))
+        workers[0].inc("ai_answers_streams_in_flight", {})
+        workers[0].flush()
+        self.assertIn("ai_answers_streams_in_flight 1\n", workers[1].render())
+        self.assertEqual(workers[0]._db().execute("SELECT COUNT(*) FROM gauges WHERE pid = ?", (gone.pid,)).fetchone()[0], 0)
+
+        # On the asyncio engine's loop thread, a due flush is handed to another thread
+        import asyncio
+        flushed_on = []
+        metrics = ai_answers.Metrics(path, flush_interval=0)
+        flush = metrics.flush
+        metrics.flush = lambda: flushed_on.append(threading.current_thread().name) or flush()
+
+        async def on_loop():
+            metrics.inc("ai_answers_tokens_total", labels)
+        asyncio.run(on_loop())
+        while not flushed_on:
+            time.sleep(0.01)
+        self.assertEqual(flushed_on, ["ai-answers-metrics"])
+
+    def test_admission_caps_queue_and_rates(self):
+        admission = ai_answers.AdmissionControl(1, {}, 1, 0.5, 0, 1, {"quota": 2})
+        release, _ = admission.admit("p")
+        self.assertIsNotNone(release)
+
+        # One request may wait for the slot; the next is turned away at once
+        queued = []
+        waiter = threading.Thread(target=lambda: queued.append(admission.admit("p")))
+        waiter.start()
+        while not admission.stats()["queued"]:
+            time.sleep(0.01)
+        started = time.monotonic()
+        self.assertEqual(admission.admit("p"), (None, "overloaded"))
+        self.assertLess(time.monotonic() - started, 0.1)
+        release()
+        release()
+        waiter.join()
+        self.assertIsNotNone(queued[0][0])
+        self.assertEqual(admission.stats()["active"], 1)
+
+        # Nobody frees the slot: the queued request gives up at its deadline
+        self.assertEqual(admission.admit("p"), (None, "queue_timeout"))
+        queued[0][0]()
+
+        # Provider quota and per-client rate come from token buckets
+        self.assertIsNotNone(admission.admit("quota")[0])
+        self.assertEqual(admission.admit("quota"), (None, "queue_timeout"))
+        admission.max_streams = 0
+        self.assertIsNotNone(admission.admit("quota")[0])
+        self.assertEqual(admission.admit("quota"), (None, "provider_rate"))
+        self.assertEqual(admission.stats()["rejected"], {"overloaded": 1, "queue_timeout": 2, "provider_rate": 1})
+
+        limited = ai_answers.AdmissionControl(0, {}, 0, 0, 60, 2, {})
+        self.assertEqual([limited.allow_client("1.2.3.4") for _ in range(3)], [True, True, False])
+        self.assertTrue(limited.allow_client("5.6.7.8"))
+
+        # Metrics may flush to SQLite, so they are never written while admit() and release() are locked out
+        class LockCheckingMetrics:
+            def __init__(self):
+                self.calls = []
+
+            def inc(self, family, labels, amount=1):
+                def probe():
+                    free = checked._cond.acquire(timeout=1)
+                    if free:
+                        checked._cond.release()
+                    self.calls.append((family, free))
+                prober = threading.Thread(target=probe)
+                prober.start()
+                prober.join()
+
+        metrics = LockCheckingMetrics()
+        checked = ai_answers.AdmissionControl(1, {}, 1, 0.1, 60, 1, {}, metrics)
+        held, _ = checked.admit("p")
+        self.assertEqual(checked.admit("p"), (None, "queue_timeout"))
+        self.assertEqual(checked.admit("p", wait=False), (None, "overloaded"))
+        checked.allow_client("1.2.3.4")
+        self.assertFalse(checked.allow_client("1.2.3.4"))
+        held()
+        self.assertEqual(len(metrics.calls), 4)
+        self.assertTrue(all(free for _, free in metrics.calls), metrics.calls)
+
+    def test_prefetch_holds_admission_slot_until_generation_ends(self):
+        admission = ai_answers.AdmissionControl(1, {}, 4, 1.0, 0, 1, {})
+        prefetcher = ai_answers.Prefetcher(ai_answers.SingleFlight(), 4, claim_sec=5, max_chunks=100)
+        gate = threading.Event()
+
+        def upstream():
+            gate.wait(2)
+            yield "a"
+            return True
+
+        release, _ = admission.admit("p", wait=False)
+        self.assertTrue(prefetcher.start("k", upstream, release))
+        # Speculative work neither queues nor counts as rejected
+        self.assertEqual(admission.admit("p", wait=False), (None, "overloaded"))
+        self.assertEqual(admission.stats()["rejected"], {})
+        gate.set()
+        while prefetcher.stats()["active"]:
+            time.sleep(0.01)
+        self.assertEqual(admission.stats()["active"], 0)
+
+        # A skipped prefetch gives its slot back at once
+        release, _ = admission.admit("p", wait=False)
+        self.assertFalse(prefetcher.start("k", upstream, release))
+        self.assertEqual(admission.stats()["active"], 0)
+
+    def test_shared_generation_keeps_its_admission_slot(self):
+        if not (plugin.admission and plugin.single_flight):
+            self.skipTest("Admission or single flight disabled")
+        import re
+        content = self.app.get('/?q=who keeps the slot').data.decode('utf-8')
+        token = re.search(r'data-tk="(.*?)"', content).group(1)
+        gate = threading.Event()
+
+        def upstream(q, context_text, cache_key, abort=None, cache_ttl=None):
+            yield "a"
+            gate.wait(2)
+            yield "b"
+            return True
+
+        saved = plugin._start_answer
+        plugin._start_answer = upstream
+        try:
+            payload = {"q": "who keeps the slot", "tk": token}
+            first = self.app.post('/ai-stream', json=payload, buffered=False)
+            self.assertEqual(next(iter(first.response)), b"a")
+            active = plugin.admission.stats()["active"]
+            self.assertGreaterEqual(active, 1)
+            joiner = self.app.post('/ai-stream', json=payload, buffered=False)
+            chunks = iter(joiner.response)
+            self.assertEqual(next(chunks), b"a")
+
+            # The request that started the generation leaves; the generation keeps its slot for the joiner
+            first.close()
+            self.assertEqual(plugin.admission.stats()["active"], active)
+            gate.set()
+            self.assertEqual(list(chunks), [b"b"])
+            joiner.close()
+            self.assertEqual(plugin.admission.stats()["active"], active - 1)
+        finally:
+            plugin._start_answer = saved
+
+    def test_disconnect_watcher_stops_abandoned_streams(self):
+        import socket
+        watcher = ai_answers.DisconnectWatcher(0.05)
+        gone = []
+        server_side, client_side = socket.socketpair()
+        try:
+            watcher.watch("t1", server_side, lambda: gone.append("t1"))
+            unwatch = watcher.watch("t2", None, lambda: gone.append("t2"))
+            time.sleep(0.2)
+            self.assertEqual(gone, [])
+            client_side.close()
+            deadline = time.monotonic() + 2
+            while not gone and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(gone, ["t1"])
+            # The beacon path; a finished response unwatches and cannot fire any more
+            self.assertTrue(watcher.cancel("t2"))
+            self.assertFalse(watcher.cancel("t2"))
+            unwatch()
+            self.assertEqual(gone, ["t1", "t2"])
+            self.assertEqual(watcher.stats(), {"disconnect": 1, "beacon": 1, "watched": 0})
+        finally:
+            server_side.close()
+
+        # Aborting before the upstream registered still stops it once it does
+        upstream = ai_answers._Abort()
+        upstream()
+        stopped = []
+        upstream.set(lambda: stopped.append(True))
+        self.assertEqual(stopped, [True])
+
+    def test_warmup_loads_local_model_and_reports_readiness(self):
+        import mock_llm
+        upstream = mock_llm.MockLLMServer(ttft=0, token_rate=0, tokens=1).start()
+        pool = ai_answers.ConnectionPool(2, 30)
+        local = ai_answers.Backend("openrouter", "m", "key", upstream.address, 100, 0.2)
+        down = ai_answers.Backend("openrouter", "m", "key", "127.0.0.1:9", 100, 0.2)
+        engine = ai_answers.AsyncStreamEngine(4)
+        warmup = ai_answers.Warmup([down, local], pool, refresh_sec=0, engine=engine)
+        self.assertFalse(warmup.ready)
+        warmup._run()
+        stats = warmup.stats()
+        self.assertTrue(stats["ready"])
+        self.assertEqual(stats["backends"][local.name]["warmed"], "model")
+        self.assertEqual(stats["backends"][down.name]["state"], "failed")
+        self.assertEqual(upstream.stats["requests"], 1)
+        # The warm-up connection stays in the pool for the first answer; routed answers on the
+        # engine get one parked there
+        self.assertEqual(pool.stats()[f"http://{upstream.address}"], 1)
+        self.assertEqual(engine.pool_stats()[f"http://{upstream.address}"], 1)
+        self.assertEqual(self.app.get('/ai-ready').status_code, 200)
+
+    def test_prewarmed_tls_connections_are_reused(self):
+        import ssl
+        import subprocess
+        import tempfile
+        from unittest import mock
+        import mock_llm
+        tmp = tempfile.mkdtemp()
+        cert, key = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+        try:
+            subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+                            "-addext", "subjectAltName=IP:127.0.0.1", "-keyout", key, "-out", cert],
+                           check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest("openssl not available")
+        server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_ctx.minimum_version = ssl.TLSVersion.TLSv1_3
+        server_ctx.load_cert_chain(cert, key)
+        upstream = mock_llm.MockLLMServer(ttft=0, token_rate=0, tokens=3, ssl=server_ctx).start()
+        req = ai_answers.Backend("openrouter", "m", "key", upstream.address, 100, 0.2).request("q")._replace(secure=True)
+
+        with mock.patch.object(ai_answers, "_ssl_context", lambda: ssl.create_default_context(cafile=cert)):
+            # Blocking pool: the session tickets sent after the handshake do not make the parked socket look dead
+            pool = ai_answers.ConnectionPool(2, 30)
+            self.assertGreater(pool.prewarm(upstream.address, True), 0)
+            time.sleep(0.2)
+            self.assertEqual(pool.prewarm(upstream.address, True), 0.0)
+            conn, reused = pool.acquire(upstream.address, True)
+            self.assertTrue(reused)
+            conn.close()
+
+            # Async engine: the answer runs on the connection warm-up parked
+            engine = ai_answers.AsyncStreamEngine(4)
+            engine.submit(engine.prewarm(upstream.address, True)).result()
+            time.sleep(0.2)
+            self.assertEqual("".join(engine.stream(req)), "tok0 tok1 tok2 ")
+            self.assertEqual(upstream.stats["connections"], 2)
+            self.assertEqual(upstream.stats["requests"], 1)
+
+    def test_precompute_top_queries(self):
+        sketch = ai_answers.HeavyHitters(capacity=2)
+        for q in ["sky"] * 5 + ["rain"] * 3 + [f"rare {i}" for i in range(6)] + ["Sky"]:
+            sketch.observe(q, f"context for {q.lower()}")
+        # Rare queries were pruned; the top counts are still exact
+        self.assertEqual(sketch.top(2), [("Sky", "context for sky", 6), ("rain", "context for rain", 3)])
+        self.assertLessEqual(sketch.stats()["tracked"], 4)
+
+        generated = []
+        precomputer = ai_answers.Precomputer(
+            sketch, lambda q, context: q == "rain", lambda q, context: generated.append(q) or "generated",
+            top_n=2, concurrency=2, rate_per_min=0, window="", lease=None)
+        run = precomputer.run()
+        self.assertEqual(generated, ["Sky"])
+        self.assertEqual(dict(run["outcomes"]), {"generated": 1, "cached": 1})
+        self.assertTrue(ai_answers._in_window("23:00-02:00", ai_answers.datetime.datetime(2024, 1, 1, 1, 30)))
+        self.assertFalse(ai_answers._in_window("02:00-05:00", ai_answers.datetime.datetime(2024, 1, 1, 12, 0)))
+
+        # One worker wins the lease; answers can outlive the store's default TTL
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), "store.sqlite3")
+        jobs = ai_answers.SharedStore(path, 'jobs', 60, 1024, 10)
+        self.assertEqual([jobs.claim("precompute"), jobs.claim("precompute")], [True, False])
+        answers = ai_answers.SharedStore(path, 'answers', 1, 1024, 10)
+        answers.put("k", "answer", ttl=3600)
+        time.sleep(1.1)
+        self.assertEqual(answers.get("k"), "answer")
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file